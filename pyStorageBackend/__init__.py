@@ -1,14 +1,20 @@
 
 # Project imports
+from pyStorageBackend import durability, expiry, registry
 from pyStorageBackend.uid import UID
-from pyStorageBackend.generic_backend import GenericBackend
+from pyStorageBackend.registry import register_backend
+from pyStorageBackend.exceptions import (InvalidKeyException, InvalidUIDException, InvalidDataException,
+                                         DocumentNotFoundException, InvalidSettingsException, ChangesExpiredException,
+                                         InvalidTTLException, StorageLockedException)
 
 
-# Exceptions
-class InvalidKeyException(Exception): pass
-class InvalidUIDException(Exception): pass
-class InvalidDataException(Exception): pass
-class DocumentNotFoundException(Exception): pass
+def __getattr__(name: str):
+    # GenericBackend pulls in the json cache machinery, so it's only imported when someone asks for it. Backends
+    # themselves are loaded by the registry, on first use
+    if name == "GenericBackend":
+        from pyStorageBackend.generic_backend import GenericBackend
+        return GenericBackend
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 class Storage:
@@ -19,10 +25,36 @@ class Storage:
     def __init__(self, backend, settings: dict):
         """
         Thin wrapper class around the specific implementation of GenericBackend used
-        :param settings:
+        :param backend: Backend class, or the name it's registered under (local_json, ftp_json, sqlite3, or any
+                        added with register_backend() or installed under the "pyStorageBackend.backends" entry point)
+        :param settings: Backend specific settings dict. All backends accept "durability" (none, batch or always),
+                         and "batch_interval_ms"/"batch_ops" to tune batch mode. See pyStorageBackend.durability
         """
+        # Reject unknown durability modes up front, rather than leaving it to each backend
+        if settings.get("durability", durability.NONE) not in durability.MODES:
+            raise InvalidSettingsException
+
+        # Backend modules are only imported once one is actually selected
+        if isinstance(backend, str):
+            backend = registry.get_backend(backend)
+
         self._backend = backend(settings=settings)
 
+    @classmethod
+    def from_config(cls, config: dict) -> "Storage":
+        """
+        Builds a Storage from a single config dict, selecting the backend by name, e.g.
+        Storage.from_config({"backend": "sqlite3", "path": "notes.db"})
+        :param config: Backend settings, plus "backend" naming the registered backend to use
+        :return:
+        :raises InvalidSettingsException: No "backend" given, or it isn't registered
+        """
+        settings = dict(config)
+        name = settings.pop("backend", None)
+        if name is None:
+            raise InvalidSettingsException("No backend given")
+        return cls(name, settings)
+
     def open(self):
         """
         Opens the storage medium
@@ -56,20 +88,24 @@ class Storage:
         self._validate(uid=uid)
         return self._backend.get_document(uid=uid)
 
-    def put(self, uid: UID, key, data):
+    def put(self, uid: UID, key, data, ttl: float=None):
         """
         Stores data bytes for the key given, in the document with the uid specified.
+        With a ttl the key expires that many seconds later. From then on get(), get_document() and count() act as if
+        it had been deleted, and it's reclaimed in the background (or by sweep()). Putting the key again replaces
+        its ttl, putting it without one keeps it indefinitely
         :param uid: UID of document to store in
         :param key: Key string to store data against
         :param data: Data bytes to store
+        :param ttl: Optional number of seconds the key lives for
         """
-        self._validate(uid=uid, key=key, data=data)
-        self._backend.put(uid=uid, key=key, data=data)
+        self._validate(uid=uid, key=key, data=data, ttl=ttl)
+        self._backend.put(uid, key, data, ttl=ttl)
 
     def delete(self, uid: UID, key):
         """
-        Deletes a key:value pair in the document with the uid specified
-        Fails silently if the key doesn't exist
+        Deletes a key:value pair in the document with the uid specified, and the document itself if that was its
+        last key. Fails silently if the key doesn't exist
         :param uid: UID of the document to operate on
         :param key: Key string of the key:value pair to delete
         """
@@ -102,6 +138,61 @@ class Storage:
         self._validate(uid=uid)
         return self._backend.count(uid=uid)
 
+    def stat(self, uid: UID) -> dict:
+        """
+        Returns metadata for a document, maintained as it's written so this never scans the document. Expired keys
+        are left out, as in count()
+        :param uid: UID of document to describe
+        :return: Dict of keys (number of keys), bytes (total size of values), created and modified (unix timestamps)
+        :raises DocumentNotFoundException: No document with that uid
+        """
+        self._validate(uid=uid)
+        return self._backend.stat(uid=uid)
+
+    def stats(self) -> dict:
+        """
+        Returns store-wide statistics, maintained as the store is written so this never scans it. Keys that have
+        expired are counted until they're reclaimed, see sweep()
+        :return: Dict of documents (number of documents), bytes (total size of values) and largest (list of
+                 (uid string, bytes) for the biggest documents, biggest first)
+        """
+        return self._backend.stats()
+
+    def changes(self, since: int=0, epoch: str=None):
+        """
+        Streams every change made to the store after the sequence number given, oldest first. Sequence numbers
+        increase by one per mutation and persist across restarts, so a backup or replica only needs to remember the
+        last seq it applied, and the epoch() it was applied in, and ask for changes(since=seq, epoch=epoch) next time.
+
+        Backends that only persist on sync (the json ones) can lose sequence numbers if the process dies before a
+        sync, and reuse them for different changes. Passing the epoch detects this, rather than silently skipping
+        those changes.
+        :param since: Last sequence number already seen, 0 for everything since the store was created
+        :param epoch: Epoch the consumer saw since in, or None to trust since as is
+        :return: Generator of (seq, op, uid, key) tuples. op is put, delete (including expiry) or delete_document
+                 (key is None)
+        :raises ChangesExpiredException: The retained change log doesn't reach back to since (including since=0 once
+                                         the log has been trimmed), or since was never persisted in epoch. Either
+                                         way a full copy is needed
+        """
+        yield from self._backend.changes(since=since, epoch=epoch)
+
+    def epoch(self) -> str:
+        """
+        Returns the id of the current change feed epoch, to store alongside the last seq applied from changes()
+        :return:
+        """
+        return self._backend.epoch()
+
+    def sweep(self, limit: int=expiry.SWEEP_BATCH) -> int:
+        """
+        Reclaims expired keys now, rather than waiting for the background sweeper. Work is bounded by limit, call
+        again while it returns limit to clear a backlog
+        :param limit: Maximum number of keys to reclaim
+        :return: Number of keys reclaimed
+        """
+        return self._backend.sweep(limit=limit)
+
     @staticmethod
     def generate_uid():
         """
@@ -111,7 +202,7 @@ class Storage:
         """
         return UID.new()
 
-    def _validate(self, key: str=None, uid: UID=None, data: bytes=None):
+    def _validate(self, key: str=None, uid: UID=None, data: bytes=None, ttl: float=None):
         # Validate key
         if key is not None:
             if not isinstance(key, str) or len(key) == 0 or len(key) > self.MAX_KEY_LENGTH:
@@ -124,5 +215,10 @@ class Storage:
 
         # Validate data
         if data is not None:
-            if not isinstance(data, bytes) or len(data) < self.MAX_DATA_LENGTH:
+            if not isinstance(data, bytes) or len(data) > self.MAX_DATA_LENGTH:
                 raise InvalidDataException
+
+        # Validate ttl
+        if ttl is not None:
+            if isinstance(ttl, bool) or not isinstance(ttl, (int, float)) or ttl <= 0:
+                raise InvalidTTLException
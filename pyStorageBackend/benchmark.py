@@ -0,0 +1,163 @@
+
+# Library imports
+import gc
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+# Project imports
+from pyStorageBackend import durability
+from pyStorageBackend.uid import UID
+
+
+# Modules a bare "import pyStorageBackend" must not pull in, they're only wanted once a backend is selected
+LAZY_MODULES = ("ftplib", "sqlite3", "pyStorageBackend.generic_backend", "pyStorageBackend.json_cache",
+                "pyStorageBackend.local_json_backend", "pyStorageBackend.ftp_json_backend",
+                "pyStorageBackend.sqlite3_bindings")
+
+_IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import pyStorageBackend
+elapsed = time.perf_counter() - start
+print(elapsed)
+print(",".join(module for module in sys.argv[1:] if module in sys.modules))
+"""
+
+
+def _local_json_backend(directory: str, settings: dict):
+    from pyStorageBackend.local_json_backend import LocalJsonBackend
+
+    path = os.path.join(directory, "bench.json")
+    with open(path, "w") as fp:
+        fp.write("{}")
+    return LocalJsonBackend(dict(settings, path=path))
+
+
+def _sqlite3_backend(directory: str, settings: dict):
+    from pyStorageBackend.sqlite3_bindings import Sqlite3Backend
+
+    backend = Sqlite3Backend(dict(settings, path=os.path.join(directory, "bench.db")))
+    backend.create()
+    return backend
+
+
+def _percentile(samples: [float], fraction: float) -> float:
+    return sorted(samples)[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def benchmark_durability(ops: int=500, threads: int=4):
+    """
+    Reports put() latency and throughput for every backend and durability mode, with a single writer and with
+    several concurrent writers. Throughput includes close(), so pending batch commits are paid for
+    :param ops: Number of puts per writer thread
+    :param threads: Number of writer threads for the concurrent run
+    """
+    backends = (("local_json", _local_json_backend), ("sqlite3", _sqlite3_backend))
+
+    print("{:<12}{:<8}{:>8}{:>12}{:>12}{:>12}".format("backend", "mode", "threads", "mean ms", "p99 ms", "ops/s"))
+    for name, factory in backends:
+        for mode in durability.MODES:
+            for writers in (1, threads):
+                directory = tempfile.mkdtemp()
+                try:
+                    backend = factory(directory, {"durability": mode})
+                    backend.open()
+                    latencies = []
+
+                    def worker(index: int):
+                        uid = UID("{:02d}".format(index) + "b" * 30)
+                        for op in range(ops):
+                            start = time.perf_counter()
+                            backend.put(uid, "key{}".format(op % 32), b"x" * 64)
+                            latencies.append(time.perf_counter() - start)
+
+                    workers = [threading.Thread(target=worker, args=(index,)) for index in range(writers)]
+                    start = time.perf_counter()
+                    for thread in workers:
+                        thread.start()
+                    for thread in workers:
+                        thread.join()
+                    backend.close()
+                    elapsed = time.perf_counter() - start
+
+                    print("{:<12}{:<8}{:>8}{:>12.3f}{:>12.3f}{:>12.0f}".format(
+                        name, mode, writers, 1000 * sum(latencies) / len(latencies),
+                        1000 * _percentile(latencies, 0.99), len(latencies) / elapsed))
+
+                finally:
+                    shutil.rmtree(directory)
+
+
+def benchmark_import(runs: int=10):
+    """
+    Reports how long a fresh interpreter takes to import the package, and fails if the import loaded any of
+    LAZY_MODULES. Each run is a new process, so nothing is already cached in sys.modules
+    :param runs: Number of interpreters to time, the median is reported
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, (root, os.environ.get("PYTHONPATH")))))
+
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", _IMPORT_SCRIPT] + list(LAZY_MODULES), env=env, check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout.splitlines()
+        samples.append(float(output[0]))
+        loaded = output[1] if len(output) > 1 else ""
+        if loaded:
+            raise AssertionError("import pyStorageBackend eagerly loaded: {}".format(loaded))
+
+    print("{:<24}{:>12.2f}".format("import ms (median)", 1000 * _percentile(samples, 0.5)))
+
+
+def benchmark_memory(documents: int=50000, lookups: int=20000):
+    """
+    Reports the memory held by a JsonCache in the default dict layout and the compact layout, the peak memory used
+    while opening it, and the cost of get() and get_document() in each. Documents are note-like, repeating the same
+    handful of keys
+    :param documents: Number of documents in the store
+    :param lookups: Number of get() and get_document() calls to time
+    """
+    from pyStorageBackend.json_cache import JsonCache
+
+    contents = json.dumps({str(UID.new()): {
+        "title": "Note {}".format(index), "body": "Lorem ipsum dolor sit amet " * 4, "date": "2017-01-01",
+        "tags": "storage,json"} for index in range(documents)})
+
+    print("{:<10}{:>12}{:>12}{:>12}{:>14}{:>18}".format("layout", "MB", "peak MB", "bytes/doc", "get() us",
+                                                       "get_document() us"))
+    for layout, compact in (("dict", False), ("compact", True)):
+        gc.collect()
+        tracemalloc.start()
+        cache = JsonCache(read_method=lambda: contents, overwrite_method=lambda chunks: None,
+                          set_lock_method=lambda: True, release_lock_method=lambda: None, compact=compact)
+        gc.collect()
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        uids = list(cache.keys())[:lookups]
+        start = time.perf_counter()
+        for uid in uids:
+            cache.get(uid, "title")
+        get_time = (time.perf_counter() - start) / len(uids)
+        start = time.perf_counter()
+        for uid in uids:
+            cache[uid]
+        document_time = (time.perf_counter() - start) / len(uids)
+
+        print("{:<10}{:>12.1f}{:>12.1f}{:>12.0f}{:>14.2f}{:>18.2f}".format(
+            layout, size / 2 ** 20, peak / 2 ** 20, size / documents, 1e6 * get_time, 1e6 * document_time))
+        del cache
+
+
+if __name__ == "__main__":
+
+    benchmark_import()
+    benchmark_durability()
+    benchmark_memory()
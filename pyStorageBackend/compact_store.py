@@ -0,0 +1,275 @@
+
+# Library imports
+import threading
+from array import array
+
+
+class KeyTable:
+
+    def __init__(self):
+        """
+        Interns key strings, mapping each distinct key to a small integer id. Ids are never reused or removed, so a
+        key id stays valid for the lifetime of the table
+        """
+        self._ids = {}
+        self._keys = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def intern(self, key: str) -> int:
+        """
+        Returns the id for key, adding it to the table if it's new
+        :param key:
+        :return:
+        """
+        key_id = self._ids.get(key, None)
+        if key_id is None:
+            with self._lock:
+                key_id = self._ids.get(key, None)
+                if key_id is None:
+                    key_id = len(self._keys)
+                    self._keys.append(key)
+                    self._ids[key] = key_id
+        return key_id
+
+    def find(self, key: str) -> int:
+        """
+        Returns the id for key, or None if it has never been interned
+        :param key:
+        :return:
+        """
+        return self._ids.get(key, None)
+
+    def key(self, key_id: int) -> str:
+        return self._keys[key_id]
+
+
+class CompactDocument:
+
+    __slots__ = ("fields", "arena")
+
+    def __init__(self, fields: array, arena: bytearray):
+        """
+        Immutable document record. fields is a flat array of (key id, arena offset, value length) triples, pointing
+        into arena
+        :param fields:
+        :param arena:
+        """
+        self.fields = fields
+        self.arena = arena
+
+    def __len__(self):
+        return len(self.fields) // 3
+
+    def index(self, key_id: int) -> int:
+        # Linear scan, documents hold a handful of keys so this beats keeping a per-document index
+        fields = self.fields
+        for position in range(0, len(fields), 3):
+            if fields[position] == key_id:
+                return position
+        return -1
+
+
+class CompactStore:
+
+    TYPECODE = "I"
+    DEFRAG_MIN_GARBAGE = 1 << 20
+    DEFRAG_RATIO = 1.0
+
+    def __init__(self):
+        """
+        Compact in-memory layout for JsonCache documents. Keys are interned into a shared KeyTable, each document is
+        a slotted CompactDocument of key ids, and the utf-8 value bytes live in one shared bytearray arena.
+
+        Fields are 32 bit, so an arena (live values plus garbage) is limited to 4GB.
+
+        Records are copy-on-write, put() and delete() return a new record and the old value bytes are left behind in
+        the arena as garbage. Once garbage outweighs live data (by DEFRAG_RATIO, and at least DEFRAG_MIN_GARBAGE
+        bytes) defrag() should be called to copy live values into a fresh arena.
+
+        Each record keeps a reference to the arena it was built against. defrag() swaps in a new arena object
+        rather than compacting the old one in place, so records (and snapshots of them) taken before a defrag stay
+        readable until they're dropped.
+        """
+        self.keys = KeyTable()
+        self.arena = bytearray()
+        self._live = 0
+        self._arena_lock = threading.Lock()
+
+    @property
+    def garbage(self) -> int:
+        return len(self.arena) - self._live
+
+    def pack(self, doc: dict) -> CompactDocument:
+        """
+        Builds a record from a dict of key: value strings
+        :param doc:
+        :return:
+        """
+        fields = []
+        for key, value in doc.items():
+            fields.extend((self.keys.intern(key),) + self._append(value))
+        return CompactDocument(array(self.TYPECODE, fields), self.arena)
+
+    def unpack(self, record: CompactDocument) -> dict:
+        """
+        Materialises a record as a new dict of key: value strings
+        :param record:
+        :return:
+        """
+        arena = record.arena
+        fields = record.fields
+        return {self.keys.key(fields[position]): self._value(arena, fields[position + 1], fields[position + 2])
+                for position in range(0, len(fields), 3)}
+
+    def get(self, record: CompactDocument, key: str) -> str:
+        """
+        Returns the value stored against key in the record, or None
+        :param record:
+        :param key:
+        :return:
+        """
+        key_id = self.keys.find(key)
+        position = -1 if key_id is None else record.index(key_id)
+        if position < 0:
+            return None
+        return self._value(record.arena, record.fields[position + 1], record.fields[position + 2])
+
+    def put(self, record: CompactDocument, key: str, value: str) -> CompactDocument:
+        """
+        Returns a new record with value stored against key. Pass record as None to start a new document.
+        Must not run concurrently with a defrag() of the record
+        :param record:
+        :param key:
+        :param value:
+        :return:
+        """
+        key_id = self.keys.intern(key)
+        position = -1 if record is None else record.index(key_id)
+        offset, length = self._append(value)
+
+        # Replace the existing value's reference, its bytes become garbage
+        if position >= 0:
+            self._discard(record.fields[position + 2])
+            fields = array(self.TYPECODE, record.fields)
+            fields[position + 1] = offset
+            fields[position + 2] = length
+
+        # Build the new fields at their exact size, extending an array over-allocates
+        else:
+            fields = record.fields.tolist() if record is not None else []
+            fields = array(self.TYPECODE, fields + [key_id, offset, length])
+
+        return CompactDocument(fields, self.arena)
+
+    def delete(self, record: CompactDocument, key: str) -> CompactDocument:
+        """
+        Returns a new record without key, or the same record if key isn't there
+        :param record:
+        :param key:
+        :return:
+        """
+        key_id = self.keys.find(key)
+        position = -1 if key_id is None else record.index(key_id)
+        if position < 0:
+            return record
+
+        self._discard(record.fields[position + 2])
+        fields = record.fields[:position] + record.fields[position + 3:]
+        return CompactDocument(fields, record.arena)
+
+    def release(self, record: CompactDocument):
+        """
+        Accounts for a record being dropped, all of its value bytes become garbage
+        :param record:
+        """
+        self._discard(self.size(record))
+
+    @staticmethod
+    def size(record: CompactDocument) -> int:
+        """
+        Returns the total utf-8 length of the record's values
+        :param record:
+        :return:
+        """
+        fields = record.fields
+        return sum(fields[position] for position in range(2, len(fields), 3))
+
+    def needs_defrag(self) -> bool:
+        garbage = self.garbage
+        return garbage >= self.DEFRAG_MIN_GARBAGE and garbage > self._live * self.DEFRAG_RATIO
+
+    def defrag(self, records: dict) -> dict:
+        """
+        Copies the live values of every record into a fresh arena. The caller must stop all writers while this runs
+        :param records: Dict of every live record, by uid
+        :return: Dict of rebuilt records, by uid
+        """
+        arena = bytearray()
+        rebuilt = {}
+        for uid, record in records.items():
+            fields = array(self.TYPECODE, record.fields)
+            for position in range(0, len(fields), 3):
+                offset, length = fields[position + 1], fields[position + 2]
+                fields[position + 1] = len(arena)
+                arena += record.arena[offset:offset + length]
+            rebuilt[uid] = CompactDocument(fields, arena)
+
+        with self._arena_lock:
+            self.arena, self._live = arena, len(arena)
+        return rebuilt
+
+    def _append(self, value: str) -> (int, int):
+        data = value.encode("utf-8")
+        with self._arena_lock:
+            offset = len(self.arena)
+            self.arena += data
+            self._live += len(data)
+        return offset, len(data)
+
+    def _discard(self, length: int):
+        with self._arena_lock:
+            self._live -= length
+
+    @staticmethod
+    def _value(arena: bytearray, offset: int, length: int) -> str:
+        return arena[offset:offset + length].decode("utf-8")
+
+
+def test_compact_store():
+    store = CompactStore()
+
+    # Pack and unpack round trip, including non-ascii values and an empty document
+    doc = {"title": "café", "body": "☃" * 10, "empty": ""}
+    record = store.pack(doc)
+    assert store.unpack(record) == doc and store.unpack(store.pack({})) == {}
+    assert store.size(record) == sum(len(value.encode("utf-8")) for value in doc.values())
+
+    # put() and delete() are copy-on-write, the old record still reads as it was
+    updated = store.put(record, "title", "new")
+    updated = store.put(updated, "tags", "a,b")
+    assert store.unpack(record) == doc
+    assert store.unpack(updated) == dict(doc, title="new", tags="a,b")
+    assert store.get(updated, "tags") == "a,b" and store.get(updated, "missing") is None
+    deleted = store.delete(updated, "body")
+    assert "body" not in store.unpack(deleted) and store.delete(deleted, "body") is deleted
+    assert store.put(None, "only", "one").fields.tolist() == [store.keys.find("only"), len(store.arena) - 3, 3]
+
+    # The replaced and deleted values are garbage, a defrag copies only the live values into a new arena
+    records = {"a": deleted}
+    assert store.garbage > 0
+    old_arena = store.arena
+    rebuilt = store.defrag(records)
+    assert store.unpack(rebuilt["a"]) == store.unpack(deleted)
+    assert store.garbage == 0 and len(store.arena) == store.size(rebuilt["a"])
+
+    # Records built against the old arena are still readable until they're dropped
+    assert store.unpack(record) == doc and record.arena is old_arena
+
+
+if __name__ == "__main__":
+
+    test_compact_store()
+    print("done")
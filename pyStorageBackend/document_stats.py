@@ -0,0 +1,158 @@
+
+# Library imports
+import heapq
+
+
+class DocumentStats:
+
+    LARGEST = 10
+
+    def __init__(self, largest: int=LARGEST):
+        """
+        Incrementally maintained per-document sizes and timestamps, plus store-wide totals, so stat() and stats()
+        questions never need a scan of the documents.
+
+        The largest documents are found from a max-heap of (-bytes, uid), with an entry pushed whenever a document is
+        created or grows, so a document's newest entry is never smaller than it is. largest() pops from the top:
+        entries matching the document's size are the answer, a document that has shrunk since is pushed back at its
+        current size, and entries for removed documents (or from before a document grew) are dropped. So it costs
+        O(largest * log n) plus the stale entries it drops, each of which is only ever dropped once. Like
+        ExpiryIndex, the heap is rebuilt once stale entries outnumber the documents, so it stays proportional to the
+        store and the rebuild is amortised over the writes that made it necessary.
+
+        Not thread safe by itself, callers must serialise access (JsonCache holds its table lock).
+        :param largest: Number of largest documents to track
+        """
+        self._documents = {}
+        self._heap = []
+        self._largest = largest
+        self.total_bytes = 0
+
+    def __len__(self):
+        return len(self._documents)
+
+    def __contains__(self, uid: str) -> bool:
+        return uid in self._documents
+
+    def get(self, uid: str) -> (int, float, float):
+        """
+        Returns (bytes, created, modified) for the document uid. Raises KeyError if it isn't tracked
+        :param uid:
+        :return:
+        """
+        return self._documents[uid]
+
+    def set(self, uid: str, size: int, created: float, modified: float):
+        """
+        Records the size and timestamps for the document uid, replacing anything already recorded
+        :param uid:
+        :param size: Total bytes of the document's values
+        :param created: Creation timestamp
+        :param modified: Last modification timestamp
+        """
+        previous = self._documents.get(uid, None)
+        self.total_bytes += size - (previous[0] if previous is not None else 0)
+        self._documents[uid] = (size, created, modified)
+        if previous is None or size > previous[0]:
+            heapq.heappush(self._heap, (-size, uid))
+            self._compact()
+
+    def update(self, uid: str, delta: int, now: float):
+        """
+        Applies a change of delta bytes to the document uid at time now, creating its entry if needed
+        :param uid:
+        :param delta:
+        :param now:
+        """
+        size, created, _ = self._documents.get(uid, (0, now, now))
+        self.set(uid, size + delta, created, now)
+
+    def remove(self, uid: str):
+        """
+        Stops tracking the document uid
+        :param uid:
+        """
+        size, _, _ = self._documents.pop(uid)
+        self.total_bytes -= size
+
+    def largest(self) -> [(str, int)]:
+        """
+        Returns the largest documents as (uid, bytes), biggest first
+        :return:
+        """
+        found = {}
+        while self._heap and len(found) < self._largest:
+            negative, uid = heapq.heappop(self._heap)
+            entry = self._documents.get(uid, None)
+
+            # Removed, already found, or an entry from before the document grew (a newer one covers it)
+            if entry is None or uid in found or entry[0] > -negative:
+                continue
+
+            # Shrunk since this entry was pushed, so it goes back in at its current size
+            if entry[0] < -negative:
+                heapq.heappush(self._heap, (-entry[0], uid))
+                continue
+
+            found[uid] = entry[0]
+
+        # The answer stays in the heap for next time
+        for uid, size in found.items():
+            heapq.heappush(self._heap, (-size, uid))
+        return list(found.items())
+
+    def copy(self) -> dict:
+        """
+        Returns a point in time copy of every document's (bytes, created, modified)
+        :return:
+        """
+        return self._documents.copy()
+
+    def _compact(self):
+        # Rebuild from the documents once stale entries dominate, so the heap stays proportional to the store
+        if len(self._heap) > 2 * len(self._documents) + 1024:
+            self._heap = [(-entry[0], uid) for uid, entry in self._documents.items()]
+            heapq.heapify(self._heap)
+
+
+def test_document_stats(documents: int=300, ops: int=20000):
+    import random
+
+    # Random growth, shrinking and removal, checked against a full sort after every few operations
+    stats = DocumentStats(largest=10)
+    sizes = {}
+    for op in range(ops):
+        uid = "doc{}".format(random.randrange(documents))
+        action = random.random()
+        if action < 0.1 and uid in sizes:
+            stats.remove(uid)
+            del sizes[uid]
+        else:
+            previous = sizes.get(uid, 0)
+            sizes[uid] = max(0, previous + (random.randrange(-50, 100) if uid in sizes else random.randrange(1000)))
+            stats.update(uid, sizes[uid] - previous, float(op))
+
+        if op % 7 == 0:
+            expected = sorted(sizes.values(), reverse=True)[:10]
+            largest = stats.largest()
+            assert [size for _, size in largest] == expected
+            assert all(sizes[uid] == size for uid, size in largest) and len({uid for uid, _ in largest}) == len(largest)
+
+    assert stats.total_bytes == sum(sizes.values()) and len(stats) == len(sizes)
+    assert len(stats._heap) <= 2 * len(stats) + 1025
+
+    # Shrinking and removing the biggest documents doesn't need a scan to find the next ones
+    stats = DocumentStats(largest=2)
+    for index in range(5):
+        stats.set("doc{}".format(index), index * 10, 0.0, 0.0)
+    stats.remove("doc4")
+    stats.update("doc3", -25, 1.0)
+    assert stats.largest() == [("doc2", 20), ("doc1", 10)]
+    stats.update("doc0", 100, 2.0)
+    assert stats.largest() == [("doc0", 100), ("doc2", 20)]
+
+
+if __name__ == "__main__":
+
+    test_document_stats()
+    print("done")
@@ -0,0 +1,170 @@
+
+# Library imports
+import threading
+from typing import Callable
+
+
+# Durability modes, selected with the "durability" settings key
+NONE = "none"
+BATCH = "batch"
+ALWAYS = "always"
+MODES = (NONE, BATCH, ALWAYS)
+
+# Batch mode defaults, overridden with the "batch_interval_ms" and "batch_ops" settings keys
+BATCH_INTERVAL_MS = 50
+BATCH_OPS = 1000
+
+
+class GroupCommit:
+
+    def __init__(self, commit_method: Callable[[], None], interval_ms: float=BATCH_INTERVAL_MS,
+                 max_ops: int=BATCH_OPS):
+        """
+        Batches writes into periodic durable commits. Writers call record() after every write. Once max_ops writes
+        are pending, the writer that tips it over runs the commit inline, and a background thread commits whatever is
+        pending every interval_ms.
+
+        Only one commit runs at a time. Writers that arrive while a commit is in progress don't wait for it, their
+        write is picked up by the next one, so any number of concurrent writers share a single fsync.
+
+        :param None commit_method(): Makes every write so far durable (typically ending in an fsync)
+        :param interval_ms: Maximum time a write can sit uncommitted, in milliseconds
+        :param max_ops: Maximum number of writes that can sit uncommitted
+        """
+        self._commit = commit_method
+        self._interval = interval_ms / 1000.0
+        self._max_ops = max_ops
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Starts the background commit thread
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="GroupCommit", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the background commit thread, and commits anything still pending
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def record(self, ops: int=1):
+        """
+        Records writes, committing inline if that takes the pending count to max_ops
+        :param ops: Number of writes to record
+        """
+        with self._pending_lock:
+            self._pending += ops
+            due = self._pending >= self._max_ops
+
+        if due:
+            self._try_commit(blocking=False)
+
+    def flush(self):
+        """
+        Commits anything pending, waiting for an in-progress commit to finish first
+        """
+        self._try_commit(blocking=True)
+
+    def _try_commit(self, blocking: bool):
+        # If another commit is already running, non-blocking callers leave their writes to the next one
+        if not self._commit_lock.acquire(blocking=blocking):
+            return
+
+        try:
+            # Claim everything pending before committing, writes that land during the commit count towards the next
+            with self._pending_lock:
+                pending, self._pending = self._pending, 0
+
+            if pending:
+                try:
+                    self._commit()
+
+                # Put the claimed writes back so the next attempt retries them, then re-raise
+                except:
+                    with self._pending_lock:
+                        self._pending += pending
+                    raise
+
+        finally:
+            self._commit_lock.release()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self._try_commit(blocking=False)
+            except Exception as e:
+                print("Group commit failed: {}".format(e))
+
+
+def test_group_commit():
+    commits = []
+    committed = threading.Event()
+    failures = []
+
+    def commit():
+        if failures:
+            raise failures.pop()
+        commits.append(1)
+        committed.set()
+
+    # Commits inline once max_ops writes are pending, and not before
+    group = GroupCommit(commit_method=commit, interval_ms=60000, max_ops=3)
+    group.record()
+    group.record()
+    assert len(commits) == 0
+    group.record()
+    assert len(commits) == 1
+    group.record(ops=3)
+    assert len(commits) == 2
+
+    # Nothing pending, nothing to commit
+    group.flush()
+    assert len(commits) == 2
+
+    # A failed commit puts its writes back, so the next attempt retries them
+    failures.append(IOError("disk full"))
+    group.record(ops=2)
+    try:
+        group.record()
+    except IOError:
+        pass
+    else:
+        raise AssertionError("Commit failure was swallowed")
+    assert len(commits) == 2
+    group.flush()
+    assert len(commits) == 3
+
+    # The background thread commits pending writes every interval
+    group = GroupCommit(commit_method=commit, interval_ms=10, max_ops=1000)
+    group.start()
+    committed.clear()
+    group.record()
+    assert committed.wait(5)
+    assert len(commits) == 4
+    group.stop()
+    assert len(commits) == 4
+
+    # stop() commits whatever the background thread hasn't got to yet
+    group = GroupCommit(commit_method=commit, interval_ms=60000, max_ops=1000)
+    group.start()
+    group.record()
+    assert len(commits) == 4
+    group.stop()
+    assert len(commits) == 5
+
+
+if __name__ == "__main__":
+
+    test_group_commit()
+    print("done")
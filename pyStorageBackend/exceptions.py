@@ -0,0 +1,10 @@
+
+# Exceptions
+class InvalidKeyException(Exception): pass
+class InvalidUIDException(Exception): pass
+class InvalidDataException(Exception): pass
+class DocumentNotFoundException(Exception): pass
+class InvalidSettingsException(Exception): pass
+class ChangesExpiredException(Exception): pass
+class InvalidTTLException(Exception): pass
+class StorageLockedException(Exception): pass
@@ -0,0 +1,259 @@
+
+# Library imports
+import heapq
+import threading
+from typing import Callable
+
+
+# Sweeper defaults, overridden with the "expiry_sweep_ms" and "expiry_sweep_batch" settings keys
+SWEEP_INTERVAL_MS = 1000
+SWEEP_BATCH = 1000
+
+
+class ExpiryIndex:
+
+    def __init__(self):
+        """
+        Expiry times for keys with a ttl, as a min-heap of (expires_at, uid, key) for finding what's due, and a dict
+        of uid: {key: expires_at} for lookups. Replacing or clearing an expiry leaves its old heap entry behind, these
+        are skipped when popped and the heap is rebuilt once they outnumber the live entries.
+
+        Not thread safe by itself, callers must serialise access (JsonCache holds its table lock).
+        """
+        self._heap = []
+        self._expires = {}
+        self._live = 0
+
+    def __len__(self):
+        return self._live
+
+    def get(self, uid: str, key: str) -> float:
+        """
+        Returns the expiry time for key in document uid, or None if it doesn't expire
+        :param uid:
+        :param key:
+        :return:
+        """
+        return self._expires.get(uid, {}).get(key, None)
+
+    def document(self, uid: str) -> dict:
+        """
+        Returns a copy of {key: expires_at} for every expiring key in document uid
+        :param uid:
+        :return:
+        """
+        return dict(self._expires.get(uid, {}))
+
+    def set(self, uid: str, key: str, expires_at: float=None):
+        """
+        Sets (or with None, clears) the expiry time for key in document uid
+        :param uid:
+        :param key:
+        :param expires_at: Unix timestamp
+        """
+        keys = self._expires.get(uid, None)
+        if keys is not None and keys.pop(key, None) is not None:
+            self._live -= 1
+            if not keys:
+                del self._expires[uid]
+
+        if expires_at is not None:
+            self._expires.setdefault(uid, {})[key] = expires_at
+            self._live += 1
+            heapq.heappush(self._heap, (expires_at, uid, key))
+            self._compact()
+
+    def remove_document(self, uid: str):
+        """
+        Clears every expiry in document uid
+        :param uid:
+        """
+        self._live -= len(self._expires.pop(uid, {}))
+
+    def due(self, now: float, limit: int) -> [(str, str)]:
+        """
+        Pops up to limit heap entries that are due at time now, returning the (uid, key) pairs still live.
+        Stale entries count towards the limit, so the work done is bounded either way
+        :param now:
+        :param limit:
+        :return:
+        """
+        due = []
+        while self._heap and limit > 0 and self._heap[0][0] <= now:
+            expires_at, uid, key = heapq.heappop(self._heap)
+            if self.get(uid, key) == expires_at:
+                due.append((uid, key))
+            limit -= 1
+        return due
+
+    def copy(self) -> dict:
+        """
+        Returns a point in time copy of uid: {key: expires_at}
+        :return:
+        """
+        return {uid: dict(keys) for uid, keys in self._expires.items()}
+
+    def _compact(self):
+        # Rebuild from the live entries once stale ones dominate, so the heap stays proportional to live expiries
+        if len(self._heap) > 2 * self._live + 1024:
+            self._heap = [(expires_at, uid, key) for uid, keys in self._expires.items()
+                          for key, expires_at in keys.items()]
+            heapq.heapify(self._heap)
+
+
+class Sweeper:
+
+    def __init__(self, sweep_method: Callable[[int], int], interval_ms: float=SWEEP_INTERVAL_MS,
+                 batch: int=SWEEP_BATCH):
+        """
+        Background thread that reclaims expired keys a bounded batch at a time, so expiring a large number of keys
+        is spread over many small sweeps rather than one long one. If a sweep fills its batch, the next one runs
+        straight away instead of waiting out the interval.
+        Backends create one up front and call start_once() whenever a key is given a ttl, so stores that never use
+        one don't carry an idle thread.
+        :param int sweep_method(limit): Reclaims up to limit expired keys, returns how many it reclaimed
+        :param interval_ms: Time between sweeps, in milliseconds, 0 to never start the thread
+        :param batch: Maximum number of keys per sweep
+        """
+        self._sweep = sweep_method
+        self._interval = interval_ms / 1000.0
+        self._batch = batch
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the background sweeper thread
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="Sweeper", daemon=True)
+        self._thread.start()
+
+    def start_once(self):
+        """
+        Starts the background sweeper thread, unless it's already running or the interval is 0. Cheap enough to call
+        on every write that sets a ttl
+        """
+        if self._thread is not None or not self._interval:
+            return
+        with self._lock:
+            if self._thread is None:
+                self.start()
+
+    def stop(self):
+        """
+        Stops the background sweeper thread. start_once() starts it again
+        """
+        with self._lock:
+            if self._thread is not None:
+                self._stop.set()
+                self._thread.join()
+                self._thread = None
+
+    def _run(self):
+        wait = self._interval
+        while not self._stop.wait(wait):
+            try:
+                wait = 0 if self._sweep(self._batch) >= self._batch else self._interval
+            except Exception as e:
+                print("Expiry sweep failed: {}".format(e))
+                wait = self._interval
+
+
+def test_expiry_index():
+    index = ExpiryIndex()
+    index.set("u1", "a", 10.0)
+    index.set("u1", "b", 20.0)
+    index.set("u2", "a", 5.0)
+    assert len(index) == 3 and index.get("u1", "b") == 20.0 and index.document("u1") == {"a": 10.0, "b": 20.0}
+
+    # Replacing or clearing an expiry leaves a stale heap entry, which due() skips
+    index.set("u1", "a", 30.0)
+    index.set("u2", "a", None)
+    assert index.due(now=25.0, limit=10) == [("u1", "b")]
+    assert index.due(now=25.0, limit=10) == [] and index._heap[0][0] == 30.0
+
+    # Reclaiming a due key is up to the caller, which clears its expiry
+    index.set("u1", "b", None)
+
+    # Stale entries count towards the limit, so a sweep's work is bounded
+    index.set("u3", "a", 1.0)
+    index.set("u3", "a", 2.0)
+    index.set("u3", "a", 3.0)
+    assert index.due(now=5.0, limit=2) == [] and index.due(now=5.0, limit=2) == [("u3", "a")]
+    index.set("u3", "a", None)
+
+    # Repeatedly replacing expiries rebuilds the heap, rather than letting stale entries pile up
+    for repeat in range(10000):
+        index.set("u4", "k{}".format(repeat % 10), float(repeat))
+    assert len(index) == 11 and len(index._heap) <= 2 * len(index) + 1025
+    due = index.due(now=1e9, limit=len(index._heap))
+    assert sorted(due) == sorted([("u1", "a")] + [("u4", "k{}".format(key)) for key in range(10)])
+    for uid, key in due:
+        index.set(uid, key, None)
+
+    # Removing a document clears all of its expiries, and copies are independent of the index
+    index.set("u5", "a", 1.0)
+    copy = index.copy()
+    index.remove_document("u5")
+    assert index.get("u5", "a") is None and copy["u5"] == {"a": 1.0}
+    assert len(index) == 0 and index.due(now=1e9, limit=100) == []
+
+
+def test_sweeper():
+    calls = []
+    finished = threading.Event()
+
+    # A backlog of two full batches is swept back to back, then the sweeper waits out the interval
+    def sweep(limit: int) -> int:
+        calls.append(limit)
+        if len(calls) == 3:
+            finished.set()
+        return limit if len(calls) < 3 else 0
+
+    sweeper = Sweeper(sweep_method=sweep, interval_ms=10, batch=50)
+    sweeper.start()
+    assert finished.wait(5)
+    sweeper.stop()
+    assert calls[:3] == [50, 50, 50]
+
+    # Stopping before the first interval means no sweeps at all, and a failing sweep doesn't kill the thread
+    sweeper = Sweeper(sweep_method=sweep, interval_ms=60000)
+    sweeper.start()
+    sweeper.stop()
+    failures = []
+    finished.clear()
+
+    def failing(limit: int) -> int:
+        failures.append(limit)
+        if len(failures) == 2:
+            finished.set()
+        raise IOError("disk full")
+
+    sweeper = Sweeper(sweep_method=failing, interval_ms=5, batch=1)
+    sweeper.start()
+    assert finished.wait(5)
+    sweeper.stop()
+
+    # start_once() only ever runs one thread, starts again after stop(), and does nothing with an interval of 0
+    sweeper = Sweeper(sweep_method=sweep, interval_ms=60000)
+    sweeper.start_once()
+    thread = sweeper._thread
+    sweeper.start_once()
+    assert sweeper._thread is thread and thread.is_alive()
+    sweeper.stop()
+    assert not thread.is_alive()
+    sweeper.start_once()
+    assert sweeper._thread is not None and sweeper._thread is not thread
+    sweeper.stop()
+    sweeper = Sweeper(sweep_method=sweep, interval_ms=0)
+    sweeper.start_once()
+    assert sweeper._thread is None
+
+
+if __name__ == "__main__":
+
+    test_expiry_index()
+    test_sweeper()
+    print("done")
@@ -1,16 +1,61 @@
 
 # Library imports
 import ftplib
+import hashlib
 import io
+import json
 import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Union
 
 # Project imports
 from pyStorageBackend.generic_backend import GenericJsonBackend
-from pyStorageBackend.json_cache import JsonCache
+from pyStorageBackend.json_cache import JsonCache, JsonSnapshot
+
+
+# Exceptions
+class FtpSyncException(Exception):
+    pass
 
 
 class FtpJsonBackend(GenericJsonBackend):
 
+    SEGMENT_NAME = "{}.seg{:04d}.g{}"
+    CHANGES_NAME = "{}.changes.g{}"
+    CONNECTIONS = 4
+    READ_BLOCK_SIZE = 65536
+
+    class _ChunkReader:
+
+        def __init__(self, chunks: Iterable[Union[str, bytes]]):
+            """
+            Read-only file-like pipe over an iterable of string (or bytes) chunks, for feeding storbinary(). Chunks
+            are pulled and utf-8 encoded on demand, and a running sha256 is kept of every byte handed out.
+            :param chunks:
+            """
+            self._chunks = iter(chunks)
+            self._buffer = bytearray()
+            self.hash = hashlib.sha256()
+            self.length = 0
+
+        def read(self, size: int=-1) -> bytes:
+            # Pull chunks until we can satisfy the request, or the stream is exhausted
+            while size < 0 or len(self._buffer) < size:
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    break
+                self._buffer += chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+
+            # Hand out the requested block, and keep the remainder buffered
+            size = len(self._buffer) if size < 0 else size
+            block = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            self.hash.update(block)
+            self.length += len(block)
+            return block
+
     class _FtpConnection:
 
         NOOP = "NOOP"
@@ -50,14 +95,41 @@ class FtpJsonBackend(GenericJsonBackend):
             except Exception as e:
                 print(e)
 
-        def upload(self, path: str, contents: str):
+        def checksum(self, path: str) -> str:
+            self._set_cwd(path)
+            running_hash = hashlib.sha256()
+            result = self._ftp.retrbinary("{} {}".format(self.RETR, os.path.basename(path)), running_hash.update)
+            return running_hash.hexdigest() if result.startswith(self.DOWNLOAD_SUCCESS) else None
+
+        def download_to(self, path: str, fp) -> str:
+            self._set_cwd(path)
+            running_hash = hashlib.sha256()
+
+            def callback(chunk):
+                fp.write(chunk)
+                running_hash.update(chunk)
+
+            result = self._ftp.retrbinary("{} {}".format(self.RETR, os.path.basename(path)), callback)
+            return running_hash.hexdigest() if result.startswith(self.DOWNLOAD_SUCCESS) else None
+
+        def store(self, path: str, contents: Iterable[Union[str, bytes]]) -> "FtpJsonBackend._ChunkReader":
             self._set_cwd(path)
-            fp = io.BytesIO(bytes(contents.encode("utf-8")))
+            fp = FtpJsonBackend._ChunkReader(contents)
+            self._ftp.storbinary("{} {}".format(self.STOR, os.path.basename(path)), fp)
+            print("Uploaded {} bytes".format(fp.length))
+            return fp
+
+        def upload(self, path: str, contents: Iterable[str]) -> str:
             try:
-                self._ftp.storbinary("{} {}".format(self.STOR, os.path.basename(path)), fp)
+                return self.store(path, contents).hash.hexdigest()
             except Exception as e:
                 print(e)
-            print("Uploaded {} bytes".format(len(contents)))
+                return None
+
+        def size(self, path: str) -> int:
+            self._set_cwd(path)
+            self._ftp.voidcmd("TYPE I")
+            return self._ftp.size(os.path.basename(path))
 
         def delete(self, path: str):
             self._set_cwd(path)
@@ -67,6 +139,14 @@ class FtpJsonBackend(GenericJsonBackend):
             self._set_cwd(source_path)
             self._ftp.rename(os.path.basename(source_path), new_name)
 
+        def replace(self, source_path, new_name):
+            # Rename over the target in one step where the server allows it, otherwise delete it first
+            try:
+                self.rename(source_path, new_name)
+            except ftplib.error_perm:
+                self.delete(os.path.join(os.path.dirname(source_path), new_name))
+                self.rename(source_path, new_name)
+
         def _set_cwd(self, path):
             path = os.path.dirname(path) if os.path.dirname(path).startswith("/") else "/"+os.path.dirname(path)
             path = path if path.endswith("/") else path + "/"
@@ -78,38 +158,281 @@ class FtpJsonBackend(GenericJsonBackend):
     def __init__(self, settings: dict):
         """
         Json based remote FTP implementation of GenericBackend.
+        Durability modes control how often the store is uploaded, the upload is verified but there's no remote fsync
+
+        Setting "segments" switches to a segmented remote layout. "path" becomes a small json manifest, and documents
+        are spread (by uid hash) over that many segment files alongside it, with the change log in a few files of its
+        own. sync() only uploads segments holding a changed document, over up to "connections" concurrent FTP
+        sessions, then the change log entries logged since the last sync, then swaps in the new manifest. Uploads get
+        a new generation suffix, so the old manifest and its files stay intact until the swap.
+        The manifest records the segment count. If "segments" is changed, or an existing single file store is opened
+        with it set, the next sync rewrites every document into the new layout.
+        With "cache_dir" set, segments and change log files are kept in a local directory too, and open() only
+        downloads (and only opens FTP sessions for) files whose hash doesn't match the local copy.
         :param settings:
         """
         super(FtpJsonBackend, self).__init__(settings)
+        self._manifest = None
 
     def open(self):
 
         with self._get_connection() as ftp:
             assert ftp.is_connected
 
-        self._db = JsonCache(read_method=self._read, overwrite_method=self._overwrite,
-                             set_lock_method=self._set_lock, release_lock_method=self._release_lock)
+        super(FtpJsonBackend, self).open()
+
+    def _read(self) -> Union[str, dict]:
+        if self.settings.get("segments"):
+            return self._read_segments()
 
-    def _read(self):
         with self._get_connection() as ftp:
             return ftp.download(self.settings["path"])
 
-    def _overwrite(self, contents: str):
+    def _overwrite(self, contents: JsonSnapshot):
+        if self.settings.get("segments"):
+            return self._overwrite_segments(contents)
 
         # Concat temp file path, by appending .tmp
         tempname = self.settings["path"] + '.tmp'
 
+        # Stream the contents up, then verify the remote copy by comparing running hashes rather than contents
         with self._get_connection() as ftp:
-            ftp.upload(tempname, contents)
-            download_contents = ftp.download(tempname)
+            upload_hash = ftp.upload(tempname, contents)
+            download_hash = ftp.checksum(tempname)
 
-            if contents == download_contents:
+            if upload_hash is not None and upload_hash == download_hash:
                 ftp.delete(self.settings["path"])
                 ftp.rename(tempname, os.path.basename(self.settings['path']))
 
             else:
                 print("FTP overwrite error, remote contents do not match local")
 
+    def _read_segments(self) -> dict:
+
+        # Fetch the manifest, a missing one is a new, empty store
+        with self._get_connection() as ftp:
+            try:
+                manifest = json.loads(ftp.download(self.settings["path"]))
+            except ftplib.error_perm:
+                manifest = {"generation": 0, "count": None, "segments": {}}
+
+            # A single file store being opened with segments for the first time. Its contents are the store, and as
+            # the manifest has no segment count, the first sync writes them all out as segments
+            if not self._is_manifest(manifest):
+                self._manifest = {"generation": 0, "count": None, "segments": {}}
+                return manifest
+            self._manifest = manifest
+
+            # The change log is split over files of its own. Older manifests kept it whole in a single file, or
+            # carried the log themselves
+            changes = manifest.get("changes", manifest.get(JsonCache.CHANGES_KEY, {}))
+            if "name" in changes:
+                changes = self._fetch_file(lambda: ftp, self._changes_cache_name(changes["generation"]), changes)
+
+        # Fetch every segment and change log file in parallel, and merge the segments (and their timestamps)
+        segments = [("seg" + key, entry) for key, entry in manifest["segments"].items()]
+        logs = [(self._changes_cache_name(entry["generation"]), entry) for entry in changes.get("files", [])]
+        fetched = self._parallel(self._fetch, segments + logs)
+        contents = {}
+        meta = {}
+        for documents in fetched[:len(segments)]:
+            meta.update(documents.pop(JsonCache.META_KEY, {}))
+            contents.update(documents)
+        contents[JsonCache.META_KEY] = meta
+
+        # The change log files hold consecutive runs of entries, oldest first
+        if "files" in changes:
+            changes = {"seq": changes["seq"], "epochs": changes["epochs"],
+                       "log": [change for log in fetched[len(segments):] for change in log]}
+        contents[JsonCache.CHANGES_KEY] = changes
+        return contents
+
+    def _fetch(self, session: Callable, item: (str, dict)) -> Union[dict, list]:
+        cache_name, entry = item
+        return self._fetch_file(session, cache_name, entry)
+
+    def _fetch_file(self, session: Callable, cache_name: str, entry: dict) -> Union[dict, list]:
+        cache_path = self._cache_path(cache_name)
+
+        # Use the local copy if it matches the manifest
+        if cache_path is not None and os.path.exists(cache_path) and self._file_hash(cache_path) == entry["hash"]:
+            with open(cache_path, "r") as fp:
+                return json.load(fp)
+
+        # Otherwise download it, into the local cache if there is one
+        fp = io.BytesIO() if cache_path is None else open(cache_path + ".tmp", "wb")
+        with fp:
+            if session().download_to(self._remote_path(entry["name"]), fp) != entry["hash"]:
+                raise FtpSyncException("{} does not match the manifest".format(entry["name"]))
+            if cache_path is None:
+                return json.loads(fp.getvalue().decode("utf-8"))
+
+        os.replace(cache_path + ".tmp", cache_path)
+        with open(cache_path, "r") as fp:
+            return json.load(fp)
+
+    def _overwrite_segments(self, contents: JsonSnapshot):
+
+        # A different segment count moves documents between segments, so every segment is rewritten, otherwise
+        # there's only work to do if something changed since the last sync
+        count = self.settings["segments"]
+        resegment = self._manifest.get("count") != count
+        if not contents.dirty and not resegment:
+            return
+
+        # Find the segments holding a changed document (or all of them), and every document that lives in them
+        generation = self._manifest["generation"] + 1
+        members = {self._segment(uid): [] for uid in (contents.uids() if resegment else contents.dirty)}
+        for uid in contents.uids():
+            segment = self._segment(uid)
+            if segment in members:
+                members[segment].append(uid)
+
+        # Upload the dirty segments in parallel under new names
+        def store(session, segment):
+            return self._store_segment(session, contents, generation, *segment)
+
+        segments = {} if resegment else dict(self._manifest["segments"])
+        segments.update(self._parallel(store, members.items()))
+
+        with self._get_connection() as ftp:
+
+            # Then the change log, and the manifest pointing at it all
+            changes = self._store_changes(lambda: ftp, contents.changes, generation)
+            manifest = {"generation": generation, "count": count, "segments": segments, "changes": changes}
+
+            # Swap the manifest in, verifying it first as it's the one file that has to be right
+            tempname = self.settings["path"] + '.tmp'
+            manifest_hash = ftp.upload(tempname, [json.dumps(manifest)])
+            if manifest_hash is None or manifest_hash != ftp.checksum(tempname):
+                raise FtpSyncException("FTP overwrite error, remote manifest does not match local")
+            ftp.replace(tempname, os.path.basename(self.settings["path"]))
+
+            # Tidy up the files the new manifest replaced, and the local copies of change log files it dropped
+            replaced = [entry for key, entry in self._manifest["segments"].items()
+                        if key not in segments or entry["name"] != segments[key]["name"]]
+            kept = {entry["name"] for entry in changes["files"]}
+            dropped = [entry for entry in self._change_files(self._manifest) if entry["name"] not in kept]
+            for previous in replaced + dropped:
+                try:
+                    ftp.delete(self._remote_path(previous["name"]))
+                except ftplib.error_perm as e:
+                    print(e)
+            for previous in dropped:
+                cache_path = self._cache_path(self._changes_cache_name(previous["generation"]))
+                if cache_path is not None and os.path.exists(cache_path):
+                    os.remove(cache_path)
+
+        self._manifest = manifest
+
+    def _store_changes(self, session: Callable, changes: dict, generation: int) -> dict:
+        log = changes["log"]
+        oldest = log[0][0] if log else changes["seq"] + 1
+
+        # Files holding only entries older than the log keeps are dropped. Each sync then uploads just the entries
+        # logged since the last one, in a new file that absorbs the newest earlier files while they're under twice
+        # its size. Every file so holds at least twice the entries of the next, leaving O(log n) files, and an entry
+        # is only uploaded again into a file half as large again, so O(log n) times
+        files = [entry for entry in self._change_files(self._manifest) if entry.get("last", -1) >= oldest]
+        first = max(files[-1]["last"] + 1 if files else 0, oldest)
+        if first <= changes["seq"]:
+            while files and files[-1]["last"] - max(files[-1]["first"], oldest) < 2 * (changes["seq"] - first) + 1:
+                first = max(files.pop()["first"], oldest)
+
+            name = self.CHANGES_NAME.format(os.path.basename(self.settings["path"]), generation)
+            entry = self._store_file(session, name, self._changes_cache_name(generation),
+                                     [json.dumps([change for change in log if change[0] >= first])], generation)
+            entry.update(first=first, last=changes["seq"])
+            files.append(entry)
+
+        return {"seq": changes["seq"], "epochs": changes["epochs"], "files": files}
+
+    def _store_segment(self, session: Callable, contents: JsonSnapshot, generation: int, segment: int,
+                       uids: [str]) -> (str, dict):
+        key = "{:04d}".format(segment)
+        name = self.SEGMENT_NAME.format(os.path.basename(self.settings["path"]), segment, generation)
+        return key, self._store_file(session, name, "seg" + key, contents.encode(uids), generation)
+
+    def _store_file(self, session: Callable, name: str, cache_name: str, chunks: Iterable[str],
+                    generation: int) -> dict:
+        cache_path = self._cache_path(cache_name)
+        ftp = session()
+
+        # Stream the file straight up, or via the local cache file when there is one
+        if cache_path is None:
+            uploaded = ftp.store(self._remote_path(name), chunks)
+
+        else:
+            with open(cache_path + ".tmp", "w") as fp:
+                fp.writelines(chunks)
+            with open(cache_path + ".tmp", "rb") as fp:
+                uploaded = ftp.store(self._remote_path(name), iter(lambda: fp.read(self.READ_BLOCK_SIZE), b""))
+
+        # Check the remote size rather than downloading the file again
+        if ftp.size(self._remote_path(name)) != uploaded.length:
+            raise FtpSyncException("{} upload is incomplete".format(name))
+
+        if cache_path is not None:
+            os.replace(cache_path + ".tmp", cache_path)
+        return {"name": name, "hash": uploaded.hash.hexdigest(), "generation": generation}
+
+    def _parallel(self, method: Callable, items: Iterable) -> list:
+        # Runs method(session, item) for every item over a small pool of worker threads. session() returns the
+        # worker's FTP session, logging in on the first call only, so items served from the local cache open none
+        local = threading.local()
+        sessions = []
+
+        def session():
+            ftp = getattr(local, "ftp", None)
+            if ftp is None:
+                ftp = local.ftp = self._get_connection().__enter__()
+                sessions.append(ftp)
+            return ftp
+
+        def run(item):
+            return method(session, item)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.settings.get("connections", self.CONNECTIONS)) as pool:
+                return list(pool.map(run, items))
+        finally:
+            for ftp in sessions:
+                ftp.__exit__()
+
+    def _segment(self, uid: str) -> int:
+        return zlib.crc32(uid.encode("utf-8")) % self.settings["segments"]
+
+    def _remote_path(self, name: str) -> str:
+        return os.path.join(os.path.dirname(self.settings["path"]), name)
+
+    def _cache_path(self, cache_name: str) -> str:
+        if not self.settings.get("cache_dir"):
+            return None
+        return os.path.join(self.settings["cache_dir"],
+                            "{}.{}".format(os.path.basename(self.settings["path"]), cache_name))
+
+    @staticmethod
+    def _change_files(manifest: dict) -> [dict]:
+        # The change log files a manifest lists, or the single file older manifests kept the whole log in
+        changes = manifest.get("changes", {})
+        return changes.get("files", [changes] if "name" in changes else [])
+
+    @staticmethod
+    def _changes_cache_name(generation: int) -> str:
+        return "changes.g{}".format(generation)
+
+    @staticmethod
+    def _is_manifest(contents: dict) -> bool:
+        # Documents are keyed by uid, so a store can't have these top level keys
+        return isinstance(contents.get("segments", None), dict) and "generation" in contents
+
+    def _file_hash(self, path: str) -> str:
+        running_hash = hashlib.sha256()
+        with open(path, "rb") as fp:
+            for block in iter(lambda: fp.read(self.READ_BLOCK_SIZE), b""):
+                running_hash.update(block)
+        return running_hash.hexdigest()
+
     def _set_lock(self):
         return True
 
@@ -119,3 +442,177 @@ class FtpJsonBackend(GenericJsonBackend):
     def _get_connection(self) -> _FtpConnection:
         return self._FtpConnection(url=self.settings["url"], username=self.settings["username"],
                                    password=self.settings["password"])
+
+
+def test_chunk_reader():
+    import hashlib
+
+    chunks = ["{", "\"café\": ", b"\"\xe2\x98\x83\"", "", "}"]
+    expected = b"".join(chunk.encode("utf-8") if isinstance(chunk, str) else chunk for chunk in chunks)
+
+    # Reads of every block size reassemble the stream, with the running hash and length covering all of it
+    for size in (1, 2, 3, 7, len(expected), 1024, -1):
+        reader = FtpJsonBackend._ChunkReader(chunks)
+        blocks = list(iter(lambda: reader.read(size), b""))
+        assert b"".join(blocks) == expected
+        assert all(len(block) == size for block in blocks[:-1]) if size > 0 else len(blocks) == 1
+        assert reader.hash.hexdigest() == hashlib.sha256(expected).hexdigest()
+        assert reader.length == len(expected)
+
+    # Nothing in, nothing out
+    reader = FtpJsonBackend._ChunkReader([])
+    assert reader.read(16) == b"" and reader.length == 0
+
+
+def test_ftp_segments():
+    import shutil
+    import tempfile
+    from pyStorageBackend.uid import UID
+
+    files = {}
+    stored = []
+    sessions = []
+
+    # In-memory stand in for ftplib.FTP, just the calls the backend makes
+    class FakeFTP:
+
+        def __init__(self, host, user, passwd):
+            self._cwd = "/"
+            sessions.append(self)
+
+        def _path(self, name):
+            return self._cwd.rstrip("/") + "/" + name
+
+        def cwd(self, path):
+            self._cwd = path or "/"
+
+        def voidcmd(self, command):
+            return "200"
+
+        def quit(self):
+            pass
+
+        def close(self):
+            pass
+
+        def retrbinary(self, command, callback):
+            name = self._path(command.split(" ", 1)[1])
+            if name not in files:
+                raise ftplib.error_perm("550 No such file")
+            for position in range(0, len(files[name]), 7):
+                callback(files[name][position:position + 7])
+            return "226 Transfer complete"
+
+        def storbinary(self, command, fp):
+            name = self._path(command.split(" ", 1)[1])
+            files[name] = b"".join(iter(lambda: fp.read(8192), b""))
+            stored.append(name)
+            return "226 Transfer complete"
+
+        def size(self, name):
+            return len(files[self._path(name)])
+
+        def delete(self, name):
+            del files[self._path(name)]
+
+        def rename(self, source, target):
+            files[self._path(target)] = files.pop(self._path(source))
+
+    def open_backend(segments: int=None, **settings) -> FtpJsonBackend:
+        backend = FtpJsonBackend(dict({"url": "ftp", "username": "user", "password": "pass", "path": "/store.json",
+                                       "segments": segments}, **settings))
+        backend.open()
+        return backend
+
+    def load(entry: dict):
+        return json.loads(files["/" + entry["name"]].decode("utf-8"))
+
+    real_ftp, ftplib.FTP = ftplib.FTP, FakeFTP
+    try:
+        uids = [UID("doc{:02d}".format(index)) for index in range(10)]
+
+        # A single file store, migrated into segments the first time it's opened with them
+        files["/store.json"] = b"{}"
+        backend = open_backend()
+        for uid in uids:
+            backend.put(uid, "k", str(uid))
+        backend.close()
+        backend = open_backend(segments=4)
+        assert all(backend.get(uid, "k") == str(uid) for uid in uids)
+        backend.close()
+
+        # The manifest records the segment count, and keeps the change log in files of their own
+        manifest = json.loads(files["/store.json"].decode("utf-8"))
+        assert manifest["count"] == 4 and JsonCache.CHANGES_KEY not in manifest
+        assert manifest["changes"]["seq"] == 10 and len(manifest["changes"]["files"]) == 1
+        assert [change[0] for change in load(manifest["changes"]["files"][0])] == list(range(1, 11))
+
+        # A sync with nothing changed uploads nothing
+        backend = open_backend(segments=4)
+        del stored[:]
+        backend.sync()
+        assert stored == []
+
+        # A change uploads one segment, a change log file holding just that change, and the manifest
+        backend.put(uids[0], "k", "changed")
+        backend.sync()
+        assert len(stored) == 3 and stored[-1] == "/store.json.tmp"
+        manifest = json.loads(files["/store.json"].decode("utf-8"))
+        assert [[change[0] for change in load(entry)] for entry in manifest["changes"]["files"]] == \
+            [list(range(1, 11)), [11]]
+        backend.close()
+
+        # Syncing after every change keeps only a few change log files, each uploaded entry lands in a file at
+        # least half as large again as its last one, and the whole log comes back on open
+        backend = open_backend(segments=4)
+        uploaded = 0
+        for index in range(200):
+            backend.put(uids[index % 10], "n", index)
+            backend.sync()
+            manifest = json.loads(files["/store.json"].decode("utf-8"))
+            assert len(manifest["changes"]["files"]) <= 10
+            uploaded += len(load(manifest["changes"]["files"][-1]))
+        assert uploaded < 200 * 10
+        backend.close()
+        backend = open_backend(segments=4)
+        assert [change[0] for change in backend.changes()] == list(range(1, 212))
+        backend.close()
+
+        # With a local cache matching the manifest, opening logs in once for the manifest and downloads nothing
+        cache_dir = tempfile.mkdtemp()
+        try:
+            open_backend(segments=4, cache_dir=cache_dir).close()
+            del sessions[:]
+            backend = open_backend(segments=4, cache_dir=cache_dir)
+            assert len(sessions) == 2 and [change[0] for change in backend.changes()] == list(range(1, 212))
+            backend.close()
+        finally:
+            shutil.rmtree(cache_dir)
+
+        # Changing the segment count rewrites every segment, so a delete can't leave the document behind in a
+        # segment from the old layout
+        backend = open_backend(segments=8)
+        backend.delete_document(uids[1])
+        backend.close()
+        backend = open_backend(segments=8)
+        assert backend.get(uids[0], "k") == "changed" and backend.count(uids[1]) == 0
+        assert all(backend.get(uid, "k") == str(uid) for uid in uids[2:])
+        assert [change[1] for change in backend.changes(since=210)] == ["put", "delete_document"]
+        backend.close()
+
+        # Only the manifest, its change log and its segments are left on the server
+        manifest = json.loads(files["/store.json"].decode("utf-8"))
+        assert manifest["count"] == 8
+        assert sorted(files) == sorted(["/store.json"] +
+                                       ["/" + entry["name"] for entry in manifest["changes"]["files"]] +
+                                       ["/" + entry["name"] for entry in manifest["segments"].values()])
+
+    finally:
+        ftplib.FTP = real_ftp
+
+
+if __name__ == "__main__":
+
+    test_chunk_reader()
+    test_ftp_segments()
+    print("done")
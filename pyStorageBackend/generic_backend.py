@@ -1,8 +1,12 @@
 
+# Library imports
+import time
+
 # Project imports
+from pyStorageBackend import durability, expiry
 from pyStorageBackend.uid import UID
-from pyStorageBackend.json_cache import JsonCache
-from pyStorageBackend import DocumentNotFoundException
+from pyStorageBackend.json_cache import JsonCache, JsonSnapshot
+from pyStorageBackend.exceptions import DocumentNotFoundException, ChangesExpiredException
 
 
 class GenericBackend(object):
@@ -22,7 +26,7 @@ class GenericBackend(object):
     def get_document(self, uid):
         raise NotImplemented
 
-    def put(self, uid, key, value):
+    def put(self, uid, key, value, ttl=None):
         raise NotImplemented
 
     def delete(self, uid, key):
@@ -37,16 +41,54 @@ class GenericBackend(object):
     def count(self, uid):
         raise NotImplemented
 
+    def changes(self, since=0, epoch=None):
+        raise NotImplemented
+
+    def epoch(self):
+        raise NotImplemented
+
+    def stat(self, uid):
+        raise NotImplemented
+
+    def stats(self):
+        raise NotImplemented
+
+    def sweep(self, limit=expiry.SWEEP_BATCH):
+        raise NotImplemented
+
 
 class GenericJsonBackend(GenericBackend):
 
+    DEFAULT_DURABILITY = durability.NONE
+
     def __init__(self, settings: dict):
         """
         Generic backend, implementing a JSON cache. All operations are in memory until sync() is called.
-        _read, _overwrite, _set_lock and _release_lock must be overridden with useful functions
+        _read, _overwrite, _set_lock and _release_lock must be overridden with useful functions.
+        Instances are thread safe, see JsonCache for the locking scheme
+
+        The "durability" setting adds automatic syncs on top of that:
+            none: Only sync when asked to
+            batch: Group commit, sync once "batch_ops" writes are pending or every "batch_interval_ms"
+            always: Sync after every write. This rewrites the whole store per write, so is only sensible for small ones
+        _overwrite implementations should make the new contents durable (fsync) unless durability is none
+
+        Mutations are recorded in a change log, stored in the json file, keeping the last "changes_retention" entries.
+
+        Setting "compact_memory" holds documents in the compact in-memory layout (see CompactStore), trading some
+        CPU on get() and get_document() for lower memory use on large stores (see JsonCache)
+
+        Keys put with a ttl expire, see JsonCache. Once there are keys with a ttl, a background Sweeper reclaims
+        expired ones every "expiry_sweep_ms" (0 to disable, leaving it to sweep() and reads), up to
+        "expiry_sweep_batch" keys at a time
         """
         self._db = None
+        self._group_commit = None
         self.settings = settings
+        self.durability = settings.get("durability", self.DEFAULT_DURABILITY)
+        self._sweeper = expiry.Sweeper(sweep_method=self.sweep,
+                                       interval_ms=settings.get("expiry_sweep_ms", expiry.SWEEP_INTERVAL_MS),
+                                       batch=settings.get("expiry_sweep_batch", expiry.SWEEP_BATCH))
 
     def open(self):
         """
@@ -55,7 +97,21 @@ class GenericJsonBackend(GenericBackend):
         :return:
         """
         self._db = JsonCache(read_method=self._read, overwrite_method=self._overwrite,
-                             set_lock_method=self._set_lock, release_lock_method=self._release_lock)
+                             set_lock_method=self._set_lock, release_lock_method=self._release_lock,
+                             compact=self.settings.get("compact_memory", False),
+                             changes_retention=self.settings.get("changes_retention", JsonCache.CHANGES_RETENTION))
+
+        # Batch durability syncs in the background, and whenever enough writes are pending
+        if self.durability == durability.BATCH:
+            self._group_commit = durability.GroupCommit(
+                commit_method=self._db.sync,
+                interval_ms=self.settings.get("batch_interval_ms", durability.BATCH_INTERVAL_MS),
+                max_ops=self.settings.get("batch_ops", durability.BATCH_OPS))
+            self._group_commit.start()
+
+        # Keys with a ttl may have been loaded
+        if self._db.expiring():
+            self._sweeper.start_once()
 
     def close(self, options: dict=None):
         """
@@ -63,6 +119,10 @@ class GenericJsonBackend(GenericBackend):
         :param options:
         :return:
         """
+        self._sweeper.stop()
+        if self._group_commit is not None:
+            self._group_commit.stop()
+            self._group_commit = None
         self.sync()
         self._db.close()
         self._db = None
@@ -74,18 +134,14 @@ class GenericJsonBackend(GenericBackend):
         :param key:
         :return:
         """
-        # Try and get the document with the UID passed
+        # Try and get the string stored against the key passed, or None
         try:
-            doc = self._db[str(uid)]
+            return self._db.get(str(uid), key)
 
         # Re-raise a KeyError as a DocumentNotFoundException
         except KeyError:
             raise DocumentNotFoundException
 
-        # Return the string stored against the key passed, or None
-        else:
-            return str(doc.get(key, None))
-
     def get_document(self, uid: UID) -> dict:
         """
         Gets the entire document with the UID passed, returns it as a dict
@@ -100,9 +156,9 @@ class GenericJsonBackend(GenericBackend):
         except KeyError:
             raise DocumentNotFoundException
 
-        # Return the doc dict as is
+        # Return a copy of the doc dict, cached documents are shared between threads and must not be mutated
         else:
-            return doc
+            return dict(doc)
 
     def delete_document(self, uid: UID):
         """
@@ -118,21 +174,32 @@ class GenericJsonBackend(GenericBackend):
         except KeyError:
             raise DocumentNotFoundException
 
-    def put(self, uid: UID, key: str, value: str):
+        self._written()
+
+    def put(self, uid: UID, key: str, value: str, ttl: float=None):
         """
         Puts string value against string key, to the document with the UID passed.
         Put works as an insert or update command. If the document doesn't exist, it is created
         :param uid:
         :param key:
         :param value:
+        :param ttl: Seconds until the key expires, or None to keep it indefinitely
         :return:
         """
-        # If the document with this UID can't be found, create it
-        if not self._db[str(uid)]:
-            self._db[str(uid)] = {}
+        self._db.put(str(uid), key, str(value), expires_at=time.time() + ttl if ttl is not None else None)
+        if ttl is not None:
+            self._sweeper.start_once()
+        self._written()
 
-        # Store the value string
-        self._db[str(uid)][key] = str(value)
+    def delete(self, uid: UID, key: str):
+        """
+        Deletes the key:value pair from the document with the UID passed. Fails silently if it doesn't exist
+        :param uid:
+        :param key:
+        :return:
+        """
+        self._db.delete(str(uid), key)
+        self._written()
 
     def sync(self, options: dict=None):
         """
@@ -149,12 +216,76 @@ class GenericJsonBackend(GenericBackend):
         :return:
         """
         # Return the len() of the document, or 0 if the doc can't be found
-        return len(self._db[str(uid)]) if self._db[str(uid)] else 0
+        try:
+            return self._db.count(str(uid))
+        except KeyError:
+            return 0
+
+    def stat(self, uid: UID) -> dict:
+        """
+        Returns the metadata for the document with the UID passed
+        :param uid:
+        :return: Dict of keys, bytes, created and modified
+        """
+        # Try and get the metadata for the document with the UID passed
+        try:
+            return self._db.stat(str(uid))
+
+        # Re-raise a KeyError as a DocumentNotFoundException
+        except KeyError:
+            raise DocumentNotFoundException
+
+    def stats(self) -> dict:
+        """
+        Returns store-wide statistics
+        :return: Dict of documents, bytes and largest
+        """
+        return self._db.stats()
+
+    def changes(self, since: int=0, epoch: str=None):
+        """
+        Generator of changes made after the sequence number since, as (seq, op, uid, key) tuples, oldest first.
+        Changes are only persisted (and so survive a restart) once sync'd, along with the documents they describe.
+        Raises ChangesExpiredException if the log no longer goes back as far as since, or since was never persisted
+        in epoch
+        :param since:
+        :param epoch:
+        :return:
+        """
+        entries = self._db.changes(since, epoch)
+        if entries is None:
+            raise ChangesExpiredException
+        yield from entries
+
+    def sweep(self, limit: int=expiry.SWEEP_BATCH) -> int:
+        """
+        Reclaims up to limit expired keys now, rather than waiting for the background sweeper
+        :param limit:
+        :return: Number of keys reclaimed
+        """
+        reclaimed = self._db.sweep(limit)
+        if reclaimed:
+            self._written()
+        return reclaimed
+
+    def epoch(self) -> str:
+        """
+        Returns the current change feed epoch, a new one is started by the first write after the store is opened
+        :return:
+        """
+        return self._db.epoch
+
+    def _written(self):
+        # Apply the durability mode after a write has landed in the cache
+        if self.durability == durability.ALWAYS:
+            self._db.sync()
+        elif self._group_commit is not None:
+            self._group_commit.record()
 
     def _read(self) -> str:
         raise NotImplemented
 
-    def _overwrite(self, contents: str):
+    def _overwrite(self, contents: JsonSnapshot):
         raise NotImplemented
 
     def _set_lock(self) -> bool:
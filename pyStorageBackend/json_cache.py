@@ -1,31 +1,153 @@
 
 # Library imports
+import collections
+import itertools
 import json
-from typing import Callable
+import threading
+import time
+import uuid
+from typing import Callable, Iterable, Iterator, Tuple, Union
 
 # Project imports
-from exceptions import StorageLockedException
+from pyStorageBackend.exceptions import StorageLockedException
+from pyStorageBackend.compact_store import CompactDocument, CompactStore
+from pyStorageBackend.document_stats import DocumentStats
+from pyStorageBackend.expiry import ExpiryIndex
+
+
+class JsonSnapshot:
+
+    def __init__(self, table: dict, changes: dict, dirty: set, meta: dict, expires: dict,
+                 materialise: Callable[[object], dict]):
+        """
+        Point in time view of a JsonCache, as handed to the overwrite method by sync().
+
+        Iterating a snapshot yields the whole store encoded as json string chunks, one chunk per document, so simple
+        overwrite methods can treat it as a stream. Overwrite methods that store documents in pieces can instead use
+        documents() and encode() with the dirty set, to only rewrite what changed since the last successful sync.
+
+        :param table: Shallow copy of the cache's document table
+        :param changes: Change log, stored under JsonCache.CHANGES_KEY
+        :param dirty: Set of uids created, modified or deleted since the last successful sync
+        :param meta: Dict of (bytes, created, modified) by uid, timestamps are stored under JsonCache.META_KEY
+        :param expires: Dict of {key: expires_at} by uid, stored alongside the timestamps
+        :param None materialise(record): Turns a table record into a document dict
+        """
+        self.changes = changes
+        self.dirty = dirty
+        self._table = table
+        self._meta = meta
+        self._expires = expires
+        self._materialise = materialise
+
+    def __iter__(self) -> Iterator[str]:
+        return self.encode()
+
+    def uids(self) -> Iterable[str]:
+        return self._table.keys()
+
+    def documents(self, uids: Iterable[str]=None) -> Iterator[Tuple[str, dict]]:
+        """
+        Yields (uid, document) pairs for the uids given that still exist, or for every document
+        :param uids:
+        :return:
+        """
+        uids = self._table.keys() if uids is None else uids
+        for uid in uids:
+            record = self._table.get(uid, None)
+            if record is not None:
+                yield uid, self._materialise(record)
+
+    def encode(self, uids: Iterable[str]=None) -> Iterator[str]:
+        """
+        Incrementally encodes documents as json, yielding one chunk per document, followed by their timestamps and
+        key expiry times.
+        Output is the same as json.dumps(ensure_ascii=True), but peak memory is bounded by the largest document
+        instead of the store. With no uids, encodes the whole store including the change log
+        :param uids: Only encode these documents, and leave out the change log
+        :return: Iterator of json string chunks
+        """
+        whole = uids is None
+        uids = self._table.keys() if whole else uids
+        yield "{"
+        for uid, doc in self.documents(uids):
+            yield "{}: {}, ".format(json.dumps(uid), json.dumps(doc, ensure_ascii=True))
+
+        # Timestamps and expiry times can't be rebuilt from the documents on load, so they're stored alongside them
+        # as [created, modified] or [created, modified, {key: expires_at}]
+        yield "{}: {{".format(json.dumps(JsonCache.META_KEY))
+        for index, uid in enumerate(uid for uid in uids if uid in self._meta):
+            entry = list(self._meta[uid][1:]) + ([self._expires[uid]] if uid in self._expires else [])
+            yield "{}{}: {}".format(", " if index else "", json.dumps(uid), json.dumps(entry, ensure_ascii=True))
+        yield "}"
+
+        if whole:
+            yield ", {}: {}".format(json.dumps(JsonCache.CHANGES_KEY), json.dumps(self.changes, ensure_ascii=True))
+        yield "}"
 
 
 class JsonCache:
 
-    def __init__(self, read_method: Callable, overwrite_method: Callable[[str], None],
-                 set_lock_method: Callable[[], bool], release_lock_method: Callable):
+    LOCK_STRIPES = 64
+    CHANGES_KEY = "_changes"
+    CHANGES_RETENTION = 10000
+    META_KEY = "_meta"
+
+    def __init__(self, read_method: Callable[[], Union[str, dict]], overwrite_method: Callable[[JsonSnapshot], None],
+                 set_lock_method: Callable[[], bool], release_lock_method: Callable, compact: bool=False,
+                 changes_retention: int=CHANGES_RETENTION):
         """
         Generic json interface, with local caching. Operates as a dict like object, entirely in memory.
 
         When the dict is initialised, it reads using the read_method and parses json into local dict.
 
-        When the dict is sync'd or closed, it dumps the local dict into a json string and overwrites the file
-        using the overwrite_method.
+        When the dict is sync'd or closed, it passes a JsonSnapshot to the overwrite_method. Iterating the snapshot
+        encodes the local dict one document at a time, as a stream of json string chunks. The full json string is
+        never held in memory, so overwrite methods should consume the chunks as they arrive (write them to a file,
+        pipe them to a socket etc). The snapshot also lists which documents changed since the last sync.
 
         Simple set/release lock methods are used to prevent simultaneous operations. The lock is taken when the
         object is initialised, and released when it's closed or deleted.
 
-        :param None read_method(): Returns the json file as a string
-        :param None overwrite_method(str): Overwrites the json file with the string passed
+        The cache is safe to share between threads. Documents are copy-on-write: they are never mutated in place,
+        put() and delete() build a replacement document under a per-document lock stripe and swap it in. This means
+        sync() only needs to hold a lock long enough to take a shallow copy of the document table, and can then
+        serialise that snapshot while writers carry on. Documents returned by __getitem__ must be treated as
+        read-only.
+
+        With compact set, documents are held in a CompactStore instead of as dicts (interned keys, values packed
+        into a shared arena), and packed as the file is parsed so opening never holds the dict layout of the whole
+        store. The saving is per key (benchmark_memory() shows about a quarter less memory for note-like documents), so
+        it shrinks as values get longer. Documents are then materialised as new dicts on every __getitem__, so prefer
+        get() and count() for single lookups.
+
+        Every mutation is given a sequence number and recorded in a change log of (seq, op, uid, key) tuples, keeping
+        the last changes_retention entries. The log is stored in the json file itself under the reserved CHANGES_KEY
+        so it's overwritten atomically with the documents it describes, and sequence numbers carry on after a reload.
+
+        Sequence numbers handed out after the last sync are lost if the process dies, and would then be reused for
+        different changes. So the first change logged after a load starts a new epoch (a random id) at the last
+        persisted sequence number, and the log keeps a short history of (epoch, first seq) pairs. A consumer that
+        remembers the epoch along with its last seq can then tell whether that position was ever persisted, see
+        changes(). Loads that never write hand out no new sequence numbers, so don't need an epoch of their own. That
+        keeps the history bounded: every persisted epoch starts at a later seq than the one before, and epochs are
+        dropped once the log no longer reaches back to where the next one starts.
+
+        Per-document sizes and created/modified timestamps, and store-wide totals, are maintained on every write in a
+        DocumentStats, for stat() and stats(). Timestamps are stored in the json file under the reserved META_KEY.
+
+        Keys can be given an expiry time when put. Expired keys are invisible to get(), __getitem__ and count()
+        straight away, and are reclaimed (deleted, logged and accounted for like any other delete) either lazily when
+        a read trips over one, or by sweep(), which does a bounded amount of work per call. stat() and stats()
+        reclaim whatever has expired before reporting, so their numbers agree with count(). Expiry times are kept in
+        an ExpiryIndex and stored alongside the timestamps under META_KEY.
+
+        :param None read_method(): Returns the json file as a string, or already parsed as a dict
+        :param None overwrite_method(JsonSnapshot): Overwrites the json file with the snapshot passed
         :param bool set_lock_method(): Attempts to grab the lock, returns true/false
         :param None release_lock_method(): Releases the lock, if its held or not
+        :param compact: Use the compact in-memory layout
+        :param changes_retention: Number of change log entries to keep
         """
         # Store methods in class
         self._read = read_method
@@ -33,37 +155,385 @@ class JsonCache:
         self._set_lock = set_lock_method
         self._release_lock = release_lock_method
 
+        # Table lock guards the top level dict, stripes serialise read-modify-write of individual documents, and the
+        # sync lock stops two syncs racing each other on the same storage file
+        self._table_lock = threading.Lock()
+        self._stripes = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
+        self._sync_lock = threading.Lock()
+
         # If we can't get the lock, raise an exception
         if not self._set_lock():
             raise StorageLockedException
 
-        # Read the file from storage, parse as json string, store as dict
-        self._cache = json.loads(read_method())
+        # Read the file from storage, parse as json string, store as dict (of compact records if asked to). Compact
+        # documents are packed as the parser finishes each one, so the dict layout of the whole file never exists
+        self._store = CompactStore() if compact else None
+        contents = read_method()
+        if isinstance(contents, str):
+            self._cache = json.loads(contents, object_pairs_hook=self._pack_pairs if compact else None)
+        else:
+            self._cache = contents
+        self._dirty = set()
+
+        # Split out the change log, everything else is a document
+        changes = self._cache.pop(self.CHANGES_KEY, {})
+        self._seq = changes.get("seq", 0)
+        self._changes = collections.deque((tuple(entry) for entry in changes.get("log", [])),
+                                          maxlen=changes_retention)
+        self._epochs = [tuple(entry) for entry in changes.get("epochs", [])]
+        self._epoch_started = not self._epochs
+        if self._epoch_started:
+            self._epochs = self._start_epoch(self._epochs)
+
+        # Documents only exist while they have keys, so drop any empty ones left by older versions. Then pack
+        # whatever the parser couldn't (contents the read method had already parsed)
+        meta = self._cache.pop(self.META_KEY, {})
+        for uid in [uid for uid, doc in self._cache.items() if not len(doc)]:
+            del self._cache[uid]
+        if self._store is not None:
+            for uid, doc in self._cache.items():
+                if not isinstance(doc, CompactDocument):
+                    self._cache[uid] = self._store.pack(doc)
+
+        # Rebuild document sizes, with timestamps from the file (or now, for documents that don't have any), and any
+        # key expiry times
+        now = time.time()
+        self._stats = DocumentStats()
+        self._expiry = ExpiryIndex()
+        for uid, record in self._cache.items():
+            entry = meta.get(uid, (now, now))
+            self._stats.set(uid, self._record_size(record), entry[0], entry[1])
+            for key, expires_at in (entry[2] if len(entry) > 2 else {}).items():
+                self._expiry.set(uid, key, expires_at)
 
-    def __getitem__(self, key: str) -> str:
-        return self._cache[key]
+    def __getitem__(self, uid: str) -> dict:
+        # Reclaiming expired keys removes the document if they were all it had. Anything expiring after that is
+        # filtered out of this copy
+        if self._expired_keys(uid):
+            self._reclaim(uid)
+        doc = self._materialise(self._cache[uid])
+        expired = self._expired_keys(uid)
+        return {key: value for key, value in doc.items() if key not in expired} if expired else doc
 
-    def __delitem__(self, key):
-        del self._cache[key]
+    def __contains__(self, uid: str) -> bool:
+        return uid in self._cache
+
+    def __delitem__(self, uid: str):
+        with self._stripe(uid):
+            with self._table_lock:
+                record = self._cache.pop(uid)
+                self._stats.remove(uid)
+                self._expiry.remove_document(uid)
+                self._log("delete_document", uid, None)
+            if self._store is not None:
+                self._store.release(record)
 
     def __len__(self):
         return len(self._cache)
 
-    def values(self) -> [str]:
-        return self._cache.values()
+    def values(self) -> [dict]:
+        return self.snapshot().values()
 
     def keys(self) -> [str]:
-        return self._cache.keys()
+        return self.snapshot().keys()
+
+    def items(self) -> [(str, dict)]:
+        return self.snapshot().items()
+
+    def get(self, uid: str, key: str) -> str:
+        """
+        Returns the value stored against key in the document uid, or None. Raises KeyError if there's no document.
+        An expired key reads as None, and is reclaimed on the way out
+        :param uid:
+        :param key:
+        :return:
+        """
+        value = self._value(self._cache[uid], key)
+        if value is not None:
+            expires_at = self._expiry.get(uid, key)
+            if expires_at is not None and expires_at <= time.time():
+                self._remove(uid, key, expired_at=time.time())
+                return None
+        return value
+
+    def count(self, uid: str) -> int:
+        """
+        Returns the number of keys in the document uid, not counting expired ones. Raises KeyError if there's no
+        document
+        :param uid:
+        :return:
+        """
+        return len(self._cache[uid]) - len(self._expired_keys(uid))
+
+    def stat(self, uid: str) -> dict:
+        """
+        Returns the metadata for the document uid, leaving out expired keys (as count() does) without reclaiming
+        them. Raises KeyError if there's no document, or every key in it has expired
+        :param uid:
+        :return: Dict of keys (count), bytes (total value size), created and modified (timestamps)
+        """
+        now = time.time()
+        with self._table_lock:
+            record = self._cache[uid]
+            size, created, modified = self._stats.get(uid)
+            expired = [key for key, expires_at in self._expiry.document(uid).items() if expires_at <= now]
+        if len(expired) == len(record):
+            raise KeyError(uid)
+        size -= sum(self._size(self._value(record, key)) for key in expired)
+        return {"keys": len(record) - len(expired), "bytes": size, "created": created, "modified": modified}
+
+    def stats(self) -> dict:
+        """
+        Returns store-wide statistics, kept up to date as the store is written. Keys that have expired but haven't
+        been reclaimed yet (by the sweeper, sweep() or a read) are still counted
+        :return: Dict of documents (count), bytes (total value size) and largest (list of (uid, bytes), biggest first)
+        """
+        with self._table_lock:
+            return {"documents": len(self._cache), "bytes": self._stats.total_bytes, "largest": self._stats.largest()}
+
+    def put(self, uid: str, key: str, value: str, expires_at: float=None):
+        """
+        Stores value against key in the document uid, creating the document if needed. Replaces any expiry time the
+        key already had
+        :param uid:
+        :param key:
+        :param value:
+        :param expires_at: Unix timestamp the key expires at, or None to keep it indefinitely
+        :return:
+        """
+        with self._stripe(uid):
+            previous = self._cache.get(uid, None)
+            delta = self._size(value) - (self._size(self._value(previous, key)) if previous is not None else 0)
+
+            if self._store is None:
+                record = dict(previous or {})
+                record[key] = value
+            else:
+                record = self._store.put(previous, key, value)
+
+            with self._table_lock:
+                self._cache[uid] = record
+                self._stats.update(uid, delta, time.time())
+                self._expiry.set(uid, key, expires_at)
+                self._log("put", uid, key)
+
+        self._maybe_defrag()
+
+    def delete(self, uid: str, key: str):
+        """
+        Removes key from the document uid, and the document with its last key. Does nothing if the document or key
+        don't exist
+        :param uid:
+        :param key:
+        :return:
+        """
+        self._remove(uid, key)
+
+    def sweep(self, limit: int) -> int:
+        """
+        Reclaims up to limit expired keys, soonest expired first
+        :param limit:
+        :return: Number of keys reclaimed
+        """
+        now = time.time()
+        with self._table_lock:
+            due = self._expiry.due(now, limit)
+        return sum(self._remove(uid, key, expired_at=now) for uid, key in due)
+
+    def _remove(self, uid: str, key: str, expired_at: float=None) -> bool:
+        # Deletes key from the document uid, returning whether there was anything to delete. With expired_at set,
+        # only deletes the key if it's still expired at that time (it may have been put again since it was found)
+        with self._stripe(uid):
+            record = self._cache.get(uid, None)
+            if record is None:
+                return False
+
+            value = self._value(record, key)
+            if value is None:
+                return False
+
+            if expired_at is not None:
+                expires_at = self._expiry.get(uid, key)
+                if expires_at is None or expires_at > expired_at:
+                    return False
 
-    def items(self) -> [(str, str)]:
-        return self._cache.items()
+            if self._store is None:
+                record = {k: v for k, v in record.items() if k != key}
+            else:
+                record = self._store.delete(record, key)
+
+            with self._table_lock:
+                self._expiry.set(uid, key, None)
+                self._log("delete", uid, key)
+
+                # The document goes with its last key (see Storage.delete)
+                if len(record):
+                    self._cache[uid] = record
+                    self._stats.update(uid, -self._size(value), time.time())
+                else:
+                    del self._cache[uid]
+                    self._stats.remove(uid)
+
+        self._maybe_defrag()
+        return True
+
+    def snapshot(self) -> dict:
+        """
+        Returns a point in time copy of the document table. Safe to iterate while other threads write.
+        In compact mode every document is materialised, so this costs as much memory as the dict layout
+        :return:
+        """
+        table = self._snapshot()
+        if self._store is None:
+            return table
+        return {uid: self._store.unpack(record) for uid, record in table.items()}
 
     def sync(self):
         """
         Overwrites the stored file with the memory cache contents using the overwrite method
         :return:
         """
-        self._write(json.dumps(self._cache, ensure_ascii=True))
+        with self._sync_lock:
+
+            # Copy the change log and claim the dirty set in the same critical section as the table, so they match
+            # the documents exactly
+            with self._table_lock:
+                table = self._cache.copy()
+                meta = self._stats.copy()
+                expires = self._expiry.copy()
+                changes = {"seq": self._seq, "log": list(self._changes), "epochs": list(self._epochs)}
+                dirty, self._dirty = self._dirty, set()
+
+            # If the write fails, the documents are still dirty for the next attempt
+            try:
+                self._write(JsonSnapshot(table, changes, dirty, meta, expires, self._materialise))
+            except:
+                with self._table_lock:
+                    self._dirty |= dirty
+                raise
+
+    def changes(self, since: int=0, epoch: str=None) -> [(int, str, str, str)]:
+        """
+        Returns the logged changes with a sequence number greater than since, oldest first.
+        Returns None if changes after since have already been dropped from the log, or if epoch is given and since
+        wasn't persisted in it (the process died before syncing, and those sequence numbers have been reused)
+        :param since: Last sequence number already seen, 0 for everything
+        :param epoch: Epoch since was seen in, or None to trust since as is
+        :return: List of (seq, op, uid, key) tuples. op is put, delete (including expiry) or delete_document (where
+                 key is None)
+        """
+        with self._table_lock:
+            if epoch is not None and not self._persisted(epoch, since):
+                return None
+            if since >= self._seq:
+                return []
+
+            # Sequence numbers in the log are contiguous, so the start can be found by offset
+            oldest = self._changes[0][0] if self._changes else self._seq + 1
+            if since + 1 < oldest:
+                return None
+            return list(itertools.islice(self._changes, since + 1 - oldest, None))
+
+    @property
+    def seq(self) -> int:
+        return self._seq
+
+    @property
+    def epoch(self) -> str:
+        return self._epochs[-1][0]
+
+    def expiring(self) -> int:
+        """
+        Returns the number of keys with an expiry time
+        :return:
+        """
+        return len(self._expiry)
+
+    def _log(self, op: str, uid: str, key: str):
+        # Must be called with the table lock held, so sequence order matches the order changes were applied. The
+        # first change since loading starts this process's epoch, before it hands out any sequence numbers
+        if not self._epoch_started:
+            self._epochs = self._start_epoch(self._epochs)
+            self._epoch_started = True
+        self._seq += 1
+        self._changes.append((self._seq, op, uid, key))
+        self._dirty.add(uid)
+
+    def _start_epoch(self, epochs: [(str, int)]) -> [(str, int)]:
+        # Drop epochs that ended before the oldest retained change, nothing seen in them can be resumed anyway, then
+        # start a new one at the persisted sequence number
+        oldest = self._changes[0][0] if self._changes else self._seq + 1
+        while len(epochs) > 1 and epochs[1][1] + 1 < oldest:
+            epochs.pop(0)
+        return epochs + [(uuid.uuid4().hex, self._seq)]
+
+    def _persisted(self, epoch: str, since: int) -> bool:
+        # A position in an earlier epoch is only valid up to where the next epoch started, anything after that was
+        # never synced. Unknown epochs are from before the retained history, or a different store
+        for index, (name, _) in enumerate(self._epochs):
+            if name == epoch:
+                return index + 1 == len(self._epochs) or since <= self._epochs[index + 1][1]
+        return False
+
+    def _reclaim(self, uid: str):
+        # Deletes every key of the document uid that has expired
+        now = time.time()
+        for key in self._expired_keys(uid):
+            self._remove(uid, key, expired_at=now)
+
+    def _expired_keys(self, uid: str) -> set:
+        # Keys of the document uid that have expired but haven't been reclaimed yet
+        now = time.time()
+        with self._table_lock:
+            expires = self._expiry.document(uid)
+        return {key for key, expires_at in expires.items() if expires_at <= now}
+
+    def _snapshot(self) -> dict:
+        # Shallow copy of the table, records are never mutated so this is a consistent point in time view
+        with self._table_lock:
+            return self._cache.copy()
+
+    def _value(self, record, key: str) -> str:
+        return record.get(key, None) if self._store is None else self._store.get(record, key)
+
+    def _pack_pairs(self, pairs: [(str, object)]):
+        # Called by the json parser for every object, innermost first. Only documents are objects of nothing but
+        # strings (the reserved keys hold numbers and lists), so those are packed straight away
+        doc = dict(pairs)
+        if doc and all(isinstance(value, str) for value in doc.values()):
+            return self._store.pack(doc)
+        return doc
+
+    def _record_size(self, record) -> int:
+        if self._store is None:
+            return sum(self._size(value) for value in record.values())
+        return self._store.size(record)
+
+    @staticmethod
+    def _size(value: str) -> int:
+        return len(value.encode("utf-8")) if value is not None else 0
+
+    def _materialise(self, record) -> dict:
+        return record if self._store is None else self._store.unpack(record)
+
+    def _maybe_defrag(self):
+        # Compact the arena once it's mostly garbage. Every stripe is taken so no put() is part way through building
+        # a record against the old arena, which briefly stalls writers (amortised over the garbage collected)
+        if self._store is None or not self._store.needs_defrag():
+            return
+
+        for stripe in self._stripes:
+            stripe.acquire()
+        try:
+            with self._table_lock:
+                if self._store.needs_defrag():
+                    self._cache = self._store.defrag(self._cache)
+        finally:
+            for stripe in self._stripes:
+                stripe.release()
+
+    def _stripe(self, uid: str) -> threading.Lock:
+        return self._stripes[hash(uid) % len(self._stripes)]
 
     def close(self):
         """
@@ -73,10 +543,322 @@ class JsonCache:
         self.sync()
         self._release_lock()
         self._cache = None
+        self._store = None
         self._release_lock = self._set_lock = self._read = self._write = None
 
     def __exit__(self, *exc_info):
         self.close()
 
     def as_dict(self):
-        return self._cache.copy()
+        return self.snapshot()
+
+
+def test_json_snapshot_encode():
+
+    def check(table: dict, meta: dict, expires: dict):
+        changes = {"seq": 2, "log": [[1, "put", "a", "k"], [2, "delete", "a", "k"]]}
+        snapshot = JsonSnapshot(table, changes, set(), meta, expires, lambda record: record)
+
+        # Chunked output must be byte for byte what json.dumps gives for the same contents
+        expected = dict(table)
+        expected[JsonCache.META_KEY] = {uid: list(meta[uid][1:]) + ([expires[uid]] if uid in expires else [])
+                                        for uid in table if uid in meta}
+        expected[JsonCache.CHANGES_KEY] = changes
+        assert "".join(snapshot) == json.dumps(expected, ensure_ascii=True)
+
+        # A partial encode leaves out the change log
+        del expected[JsonCache.CHANGES_KEY]
+        assert "".join(snapshot.encode(list(table))) == json.dumps(expected, ensure_ascii=True)
+
+    # Empty store, one document, and non-ascii keys and values
+    check({}, {}, {})
+    check({"u1": {"title": "note"}}, {"u1": (4, 1.5, 2.5)}, {})
+    check({"u1": {"title": "café ☃", "über": "\U0001f600"}, "u2": {}},
+          {"u1": (13, 1.0, 2.0), "u2": (0, 3.0, 3.0)}, {"u1": {"title": 9.5}})
+
+
+def test_json_cache_threads(threads: int=8, ops_per_thread: int=400, documents: int=8):
+    import random
+
+    for compact in (False, True):
+        synced = []
+        errors = []
+        done = threading.Event()
+
+        # Every snapshot handed to the overwrite method must be valid json, even with writers running through it
+        def overwrite(snapshot: JsonSnapshot):
+            synced.append(json.loads("".join(snapshot)))
+
+        cache = JsonCache(read_method=lambda: "{}", overwrite_method=overwrite, set_lock_method=lambda: True,
+                          release_lock_method=lambda: None, compact=compact)
+
+        # Writers share documents but own their keys, putting every key and deleting every other one, so the final
+        # state is known whatever the interleaving
+        def writer(index: int):
+            try:
+                order = list(range(ops_per_thread))
+                random.shuffle(order)
+                for op in order:
+                    uid = "doc{}".format(op % documents)
+                    cache.put(uid, "t{}-{}".format(index, op), "v" * (op % 7) + "é")
+                    if op % 2:
+                        cache.delete(uid, "t{}-{}".format(index, op))
+            except BaseException as e:
+                errors.append(e)
+
+        def syncer():
+            try:
+                while not done.is_set():
+                    cache.sync()
+            except BaseException as e:
+                errors.append(e)
+
+        workers = [threading.Thread(target=writer, args=(index,)) for index in range(threads)]
+        sync_thread = threading.Thread(target=syncer)
+        sync_thread.start()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        done.set()
+        sync_thread.join()
+        if errors:
+            raise errors[0]
+
+        # A last sync must match the expected contents exactly, and so must the cache itself. Documents whose keys
+        # were all deleted are gone
+        expected = {"doc{}".format(doc): {"t{}-{}".format(index, op): "v" * (op % 7) + "é"
+                                          for index in range(threads) for op in range(0, ops_per_thread, 2)
+                                          if op % documents == doc} for doc in range(documents)}
+        expected = {uid: doc for uid, doc in expected.items() if doc}
+        cache.sync()
+        final = synced[-1]
+        del final[JsonCache.META_KEY], final[JsonCache.CHANGES_KEY]
+        assert final == expected
+        assert cache.snapshot() == expected
+        assert cache.seq == threads * ops_per_thread * 3 // 2
+        assert len(synced) > 1
+
+
+def test_json_cache_defrag(threads: int=8, ops_per_thread: int=2000):
+    defrags = []
+
+    cache = JsonCache(read_method=lambda: json.dumps({"doc{}".format(doc): {"seed": "é" * doc} for doc in range(16)}),
+                      overwrite_method=lambda snapshot: None, set_lock_method=lambda: True,
+                      release_lock_method=lambda: None, compact=True)
+
+    # Defrag as soon as garbage outweighs live data, and count how often that happens
+    store = cache._store
+    store.DEFRAG_MIN_GARBAGE = 0
+    defrag = store.defrag
+    store.defrag = lambda records: defrags.append(1) or defrag(records)
+
+    # Writers overwrite and delete their own keys in shared documents, so the arena is constantly turning over
+    errors = []
+
+    def writer(index: int):
+        try:
+            for op in range(ops_per_thread):
+                uid = "doc{}".format(op % 16)
+                cache.put(uid, "t{}-{}".format(index, op % 5), "{}:{}".format(index, op) * (op % 9 + 1))
+                if op % 3 == 0:
+                    cache.delete(uid, "t{}-{}".format(index, (op + 1) % 5))
+                assert cache.get("doc{}".format(op % 16), "seed") == "é" * (op % 16)
+        except BaseException as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=writer, args=(index,)) for index in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    # Replay each writer on its own (their keys don't overlap) to find the expected contents
+    expected = {"doc{}".format(doc): {"seed": "é" * doc} for doc in range(16)}
+    for index in range(threads):
+        for op in range(ops_per_thread):
+            expected["doc{}".format(op % 16)]["t{}-{}".format(index, op % 5)] = "{}:{}".format(index, op) * (op % 9 + 1)
+            if op % 3 == 0:
+                expected["doc{}".format(op % 16)].pop("t{}-{}".format(index, (op + 1) % 5), None)
+
+    assert defrags
+    assert cache.snapshot() == expected
+    assert all(cache[uid] == doc and cache.count(uid) == len(doc) for uid, doc in expected.items())
+
+    # Live bytes match the surviving values exactly, so the next defrag decision is made on the right numbers
+    assert len(store.arena) - store.garbage == sum(cache._size(value) for doc in expected.values()
+                                                   for value in doc.values())
+
+
+def _open_cache(files: [str], **kwargs) -> JsonCache:
+    # Opens a JsonCache over a list of file versions, reading the newest and appending a new one on every sync, so
+    # tests can reopen the store and look at exactly what was written
+    return JsonCache(read_method=lambda: files[-1], overwrite_method=lambda snapshot: files.append("".join(snapshot)),
+                     set_lock_method=lambda: True, release_lock_method=lambda: None, **kwargs)
+
+
+def test_json_cache_changes():
+    files = ["{}"]
+
+    cache = _open_cache(files)
+    for key in ("a", "b", "c"):
+        cache.put("doc", key, "v")
+    cache.delete("doc", "a")
+    assert [change[:2] for change in cache.changes()] == [(1, "put"), (2, "put"), (3, "put"), (4, "delete")]
+    assert [change[0] for change in cache.changes(since=2)] == [3, 4] and cache.changes(since=4) == []
+    cache.sync()
+
+    # Simulate a crash: a consumer sees seq 5 and 6, but the process dies before they're synced
+    first = cache.epoch
+    cache.put("doc", "d", "v")
+    cache.put("doc", "e", "v")
+    seen = cache.changes(since=4, epoch=first)[-1][0]
+    assert seen == 6
+
+    # The first write after the reload starts a new epoch at seq 4 and hands 5 and 6 out again, the consumer's
+    # position is rejected rather than those changes being skipped, while positions that were synced still resume
+    cache = _open_cache(files)
+    assert cache.epoch == first
+    cache.put("doc", "f", "v")
+    cache.put("doc", "g", "v")
+    assert cache.epoch != first and cache.seq == 6
+    assert cache.changes(since=seen, epoch=first) is None
+    assert [change[3] for change in cache.changes(since=3, epoch=first)] == ["a", "f", "g"]
+    assert cache.changes(since=6, epoch=cache.epoch) == [] and cache.changes(since=6, epoch="unknown") is None
+
+    # A clean close persists everything, so the old epoch's positions stay valid after the next reload
+    second = cache.epoch
+    cache.close()
+    cache = _open_cache(files)
+    assert cache.changes(since=6, epoch=second) == [] and cache.changes(since=5, epoch=second)[0][3] == "g"
+
+    # Opening a store without writing to it doesn't start an epoch, and written epochs are dropped as the log wraps
+    for _ in range(50):
+        cache.close()
+        cache = _open_cache(files)
+    assert cache.epoch == second and len(json.loads(files[-1])[JsonCache.CHANGES_KEY]["epochs"]) == 2
+    for _ in range(50):
+        cache.close()
+        cache = _open_cache(files, changes_retention=3)
+        cache.put("doc", "h", "v")
+    cache.close()
+    assert len(json.loads(files[-1])[JsonCache.CHANGES_KEY]["epochs"]) <= 5
+
+    # Once the log is trimmed, since=0 no longer reaches back to the start of the store
+    cache = _open_cache(files, changes_retention=3)
+    assert [change[0] for change in cache.changes(since=cache.seq - 3)] == [54, 55, 56] and cache.changes() is None
+
+
+def test_json_cache_stats():
+    files = ["{}"]
+
+    # Documents 0 to 11, sized 1 to 12 bytes with a multi-byte character in each
+    cache = _open_cache(files)
+    for index in range(12):
+        cache.put("doc{}".format(index), "a", "é" + "x" * (index - 1) if index else "x")
+        cache.put("doc{}".format(index), "b", "")
+    assert cache.stats()["documents"] == 12 and cache.stats()["bytes"] == sum(range(1, 13))
+
+    stat = cache.stat("doc11")
+    assert stat["keys"] == 2 and stat["bytes"] == 12 and stat["created"] <= stat["modified"]
+
+    # Growth folds into the leaderboard directly
+    cache.put("doc0", "a", "x" * 20)
+    assert cache.stats()["largest"][0] == ("doc0", 20) and len(cache.stats()["largest"]) == 10
+
+    # Shrinking the largest documents means one off the board has to be found, so it's rebuilt
+    cache.put("doc0", "a", "")
+    cache.put("doc11", "a", "")
+    largest = cache.stats()["largest"]
+    assert largest == [("doc{}".format(index), index + 1) for index in range(10, 0, -1)]
+
+    # Deleting the last key deletes the document, from the store and its statistics
+    cache.delete("doc11", "a")
+    cache.delete("doc11", "b")
+    assert "doc11" not in cache and cache.stats()["documents"] == 11
+    assert all(uid != "doc11" for uid, _ in cache.stats()["largest"])
+    try:
+        cache.stat("doc11")
+    except KeyError:
+        pass
+    else:
+        raise AssertionError("Empty document still has stats")
+
+    # Timestamps survive a reload, sizes are rebuilt from the documents
+    before = {uid: cache.stat(uid) for uid in cache.keys()}
+    stats = cache.stats()
+    cache.close()
+    cache = _open_cache(files)
+    assert {uid: cache.stat(uid) for uid in cache.keys()} == before and cache.stats() == stats
+
+
+def test_json_cache_expiry():
+    files = ["{}"]
+
+    past, future = time.time() - 1, time.time() + 1000
+    cache = _open_cache(files)
+    cache.put("doc", "live", "x")
+    cache.put("doc", "expired", "xx", expires_at=past)
+    cache.put("doc", "later", "xxx", expires_at=future)
+
+    # Expired keys are hidden from every read, before anything has reclaimed them
+    assert cache.count("doc") == 2 and cache.expiring() == 2
+    assert cache["doc"] == {"live": "x", "later": "xxx"}
+
+    # Reading the document reclaimed the expired key, logged as a delete, and the stats agree with count
+    assert cache.expiring() == 1 and cache.changes(cache.seq - 1) == [(cache.seq, "delete", "doc", "expired")]
+    assert cache.stat("doc")["keys"] == cache.count("doc") == 2 and cache.stat("doc")["bytes"] == 4
+
+    # get() reclaims an expired key too, and a document goes with its last key
+    cache.put("gone", "a", "x", expires_at=past)
+    assert cache.get("gone", "a") is None and "gone" not in cache
+
+    # Putting a key again without a ttl clears its expiry
+    cache.put("doc", "live", "y", expires_at=past)
+    cache.put("doc", "live", "x")
+    assert cache.get("doc", "live") == "x" and cache.expiring() == 1
+
+    # sweep() reclaims at most limit keys per call, soonest expired first (ahead of the stale entries left above)
+    for index in range(5):
+        cache.put("swept{}".format(index), "a", "x", expires_at=past - 1)
+    assert cache.sweep(2) == 2 and cache.sweep(10) == 3 and cache.sweep(10) == 0
+    assert not any(uid.startswith("swept") for uid in cache.keys())
+
+    # stat() leaves expired keys out like count(), without reclaiming them. stats() counts them until they're
+    # reclaimed, so it never has to go looking for them
+    cache.put("doc", "stale", "xxxxx", expires_at=past)
+    cache.put("stale", "a", "x", expires_at=past)
+    assert cache.stat("doc")["keys"] == cache.count("doc") == 2 and cache.stat("doc")["bytes"] == 4
+    try:
+        cache.stat("stale")
+    except KeyError:
+        pass
+    else:
+        raise AssertionError("Document with only expired keys has stats")
+    assert cache.stats()["documents"] == 2 and cache.stats()["bytes"] == 10 and cache.expiring() == 3
+    assert cache.sweep(10) == 2 and cache.stats()["documents"] == len(cache) == 1 and cache.stats()["bytes"] == 4
+
+    # Expiry times are stored with the document metadata, and survive a reopen
+    cache.sync()
+    cache.close()
+    assert json.loads(files[-1])[JsonCache.META_KEY]["doc"][2] == {"later": future}
+    cache = _open_cache(files)
+    assert cache.expiring() == 1 and cache.count("doc") == 2
+    cache.put("doc", "expired", "x", expires_at=past)
+    cache.sync()
+    cache.close()
+    cache = _open_cache(files)
+    assert cache.expiring() == 2 and cache.count("doc") == 2 and cache.sweep(10) == 1
+
+
+if __name__ == "__main__":
+
+    test_json_snapshot_encode()
+    test_json_cache_threads()
+    test_json_cache_defrag()
+    test_json_cache_changes()
+    test_json_cache_stats()
+    test_json_cache_expiry()
+    print("done")
@@ -3,17 +3,21 @@
 import os
 
 # Project imports
+from pyStorageBackend import durability
 from pyStorageBackend.generic_backend import GenericJsonBackend
+from pyStorageBackend.json_cache import JsonSnapshot
 from pyStorageBackend.file_lock import FileLock
 
 
 class LocalJsonBackend(GenericJsonBackend):
 
+    WRITE_BUFFER_SIZE = 65536
+
     def __init__(self, settings: dict):
         """
         Local JSON implementation of GenericBackend. JSON file contents are loaded into memory when opened.
         All read/write operations are in memory. Memory contents are written to json file when sync() is called
-        :param settings: Not used
+        :param settings: Dict with "path" to the json file, and optional durability settings (see GenericJsonBackend)
         """
         super(LocalJsonBackend, self).__init__(settings)
         self._file_lock = FileLock(self.settings["path"])
@@ -22,35 +26,40 @@ class LocalJsonBackend(GenericJsonBackend):
         with open(self.settings["path"], "r") as fp:
             return fp.read()
 
-    def _overwrite(self, contents):
+    def _overwrite(self, contents: JsonSnapshot):
 
         # Concat temp file path, by appending .tmp
         tempname = self.settings["path"] + '.tmp'
 
-        # Try to open the temp file, and write contents
+        # Try to open the temp file, and stream the contents into it chunk by chunk
         try:
-            fp = open(tempname, "w+")
-            fp.write(contents)
+            with open(tempname, "w", buffering=self.WRITE_BUFFER_SIZE) as fp:
+                fp.writelines(contents)
+
+                # Make sure the contents are on disk before the rename can expose them
+                if self.durability != durability.NONE:
+                    fp.flush()
+                    os.fsync(fp.fileno())
 
         # Catch any exception, delete the temp file then re-raise exception
         except:
-            os.remove(tempname)
+            if os.path.exists(tempname):
+                os.remove(tempname)
             raise
 
         # Write temporary file was successful, replace the real file with the temp one
-        else:
-            try:
-                fp.close()
-                os.replace(tempname, self._path)
+        os.replace(tempname, self.settings["path"])
 
-            except Exception as e:
-                exit()
+        # Fsync the directory too, otherwise the rename itself can be lost on power failure
+        if self.durability != durability.NONE:
+            self._fsync_directory()
 
-        # Make sure the file point gets closed
+    def _fsync_directory(self):
+        fd = os.open(os.path.dirname(os.path.abspath(self.settings["path"])), os.O_RDONLY)
+        try:
+            os.fsync(fd)
         finally:
-            fp.close()
-
-        pass
+            os.close(fd)
 
     def _set_lock(self):
         return self._file_lock.acquire()
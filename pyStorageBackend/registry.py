@@ -0,0 +1,154 @@
+
+# Library imports
+import importlib
+import threading
+from typing import Union
+
+# Project imports
+from pyStorageBackend.exceptions import InvalidSettingsException
+
+
+# Third party packages add backends by declaring entry points in this group, e.g. in setup.py:
+#   entry_points={"pyStorageBackend.backends": ["redis = my_package.redis_backend:RedisBackend"]}
+ENTRY_POINT_GROUP = "pyStorageBackend.backends"
+
+# Backends shipped with the package, as "module:Class" so nothing is imported until a backend is asked for
+_backends = {
+    "local_json": "pyStorageBackend.local_json_backend:LocalJsonBackend",
+    "ftp_json": "pyStorageBackend.ftp_json_backend:FtpJsonBackend",
+    "sqlite3": "pyStorageBackend.sqlite3_bindings:Sqlite3Backend",
+}
+_discovered = False
+_lock = threading.Lock()
+
+
+def register_backend(name: str, backend: Union[str, type]):
+    """
+    Registers a backend under name, replacing any backend already registered with that name
+    :param name: Name to select the backend by, e.g. in Storage.from_config()
+    :param backend: Backend class, or a "module:Class" string to import it from on first use
+    """
+    with _lock:
+        _backends[name] = backend
+
+
+def get_backend(name: str) -> type:
+    """
+    Returns the backend class registered under name, importing its module on first use. Entry points are only
+    scanned if name isn't already registered. The import runs without the registry lock held, so backend modules
+    can call register_backend() while they're being imported
+    :param name:
+    :return:
+    :raises InvalidSettingsException: No backend is registered or installed under name
+    """
+    with _lock:
+        if name not in _backends:
+            _discover()
+        backend = _backends.get(name, None)
+        if backend is None:
+            raise InvalidSettingsException("Unknown backend: {}".format(name))
+        if isinstance(backend, type):
+            return backend
+
+    loaded = _load(backend)
+
+    # Swap the import string (or entry point) for the class, so later lookups are a dict hit. If the name was
+    # registered again while importing, e.g. by the backend module itself, that registration wins
+    with _lock:
+        if _backends.get(name, None) is backend:
+            _backends[name] = loaded
+        current = _backends[name]
+    return current if isinstance(current, type) else loaded
+
+
+def backends() -> [str]:
+    """
+    Returns the names of every registered and installed backend, without importing any of them
+    :return:
+    """
+    with _lock:
+        _discover()
+        return sorted(_backends)
+
+
+def _discover():
+    # Add backends declared by installed packages, once, keeping the EntryPoint to load from. Must be called with the
+    # lock held. Explicitly registered backends win over entry points with the same name
+    global _discovered
+    if _discovered:
+        return
+    _discovered = True
+
+    from importlib.metadata import entry_points
+    found = entry_points()
+    found = found.select(group=ENTRY_POINT_GROUP) if hasattr(found, "select") else found.get(ENTRY_POINT_GROUP, ())
+    for entry_point in found:
+        _backends.setdefault(entry_point.name, entry_point)
+
+
+def _load(backend) -> type:
+    # Entry points know how to load themselves, including "module:Outer.Inner" values and ones with [extras].
+    # Registered strings are "module:Class", where Class may be a dotted path too
+    if hasattr(backend, "load"):
+        return backend.load()
+    module, _, attribute = backend.partition(":")
+    loaded = importlib.import_module(module)
+    for part in attribute.split("."):
+        loaded = getattr(loaded, part)
+    return loaded
+
+
+def test_registry():
+    import sys
+    import tempfile
+    from importlib.metadata import EntryPoint
+
+    # Backend modules register with the imported registry, which isn't this one when run with python -m
+    from pyStorageBackend import registry
+
+    with tempfile.TemporaryDirectory() as path:
+        sys.path.insert(0, path)
+        try:
+            # A backend module that registers itself on import, as third party backends commonly do
+            with open("{}/selfreg_backend.py".format(path), "w") as fp:
+                fp.write("from pyStorageBackend.registry import register_backend\n"
+                         "class Backend: pass\n"
+                         "class Outer:\n"
+                         "    class Inner: pass\n"
+                         "register_backend('selfreg_alias', Backend)\n")
+
+            registry.register_backend("selfreg", "selfreg_backend:Backend")
+            found = []
+            thread = threading.Thread(target=lambda: found.append(registry.get_backend("selfreg")), daemon=True)
+            thread.start()
+            thread.join(5)
+            assert not thread.is_alive(), "Importing a self-registering backend deadlocked"
+            assert found[0].__name__ == "Backend" and registry.get_backend("selfreg_alias") is found[0]
+            assert registry.get_backend("selfreg") is found[0]
+
+            # Attributes can be nested, in registered strings and entry points alike
+            registry.register_backend("nested", "selfreg_backend:Outer.Inner")
+            assert registry.get_backend("nested").__qualname__ == "Outer.Inner"
+            entry_point = EntryPoint(name="entry_point", value="selfreg_backend:Outer.Inner",
+                                     group=registry.ENTRY_POINT_GROUP)
+            with registry._lock:
+                registry._backends["entry_point"] = entry_point
+            assert registry.get_backend("entry_point") is registry.get_backend("nested")
+        finally:
+            sys.path.remove(path)
+            for name in ("selfreg", "selfreg_alias", "nested", "entry_point"):
+                registry._backends.pop(name, None)
+
+    try:
+        registry.get_backend("no such backend")
+    except registry.InvalidSettingsException:
+        pass
+    else:
+        raise AssertionError("Unknown backend was accepted")
+    assert {"local_json", "ftp_json", "sqlite3"} <= set(registry.backends())
+
+
+if __name__ == "__main__":
+
+    test_registry()
+    print("done")
@@ -1,8 +1,14 @@
 
 # Library imports
 import sqlite3
+import threading
+import time
+import uuid
+import weakref
 
 # Project imports
+from pyStorageBackend import durability, expiry
+from pyStorageBackend.exceptions import ChangesExpiredException, DocumentNotFoundException
 from pyStorageBackend.uid import UID
 
 
@@ -10,60 +16,147 @@ class Sqlite3Backend:
 
     MAX_KEY_LENGTH = 32
 
+    BUSY_TIMEOUT = 30.0
+    DEFAULT_DURABILITY = durability.ALWAYS
+    CHANGES_RETENTION = 10000
+    CHANGES_PAGE_SIZE = 1000
+    LARGEST = 10
+
+    # Per connection pragmas for each durability mode. Batch mode commits to the WAL without syncing, and the group
+    # commit checkpoints it, so every write since the last checkpoint shares a single fsync
+    PRAGMAS = {
+        durability.NONE: ("PRAGMA synchronous=OFF",),
+        durability.BATCH: ("PRAGMA journal_mode=WAL", "PRAGMA synchronous=NORMAL"),
+        durability.ALWAYS: ("PRAGMA synchronous=FULL",),
+    }
+
     class _Connection:
 
-        def __init__(self, db_path: str):
-            self._conn = sqlite3.connect(db_path)
-            self._conn.isolation_level = "EXCLUSIVE"
-            self._conn.execute("BEGIN EXCLUSIVE")
+        def __init__(self, conn: sqlite3.Connection, exclusive: bool):
+            self._conn = conn
+            self._begin = "BEGIN EXCLUSIVE" if exclusive else "BEGIN DEFERRED"
 
         def __enter__(self):
+            self._conn.execute(self._begin)
             return self._conn.cursor()
 
-        def __exit__(self, *args, **kwargs):
-            self._conn.commit()
-            self._conn.close()
+        def __exit__(self, exc_type, *args, **kwargs):
+            if exc_type is None:
+                self._conn.commit()
+            else:
+                self._conn.rollback()
+
+    class _ThreadConnection:
+
+        def __init__(self, conn: sqlite3.Connection):
+            # Only referenced from the opening thread's locals, so it's dropped when that thread exits
+            self.conn = conn
 
     def __init__(self, settings: dict):
         """
-        SQLite3 storage backend
+        SQLite3 storage backend.
+        Instances are thread safe: each thread gets its own sqlite connection, opened on first use and reused after
+        that, and closed when the thread exits (or on close()). Writes take an exclusive transaction, reads a
+        deferred one so readers don't block each other.
+
+        The "durability" setting maps onto sqlite's own sync settings:
+            none: synchronous=OFF, commits are never fsync'd
+            batch: WAL journal with synchronous=NORMAL, checkpointed (and so fsync'd) once "batch_ops" writes are
+                   pending or every "batch_interval_ms". Needs open() to have been called to start the group commit
+            always: synchronous=FULL, every commit is fsync'd (default)
+
+        Every mutation is logged to a changes table in the same transaction, keeping the last "changes_retention"
+        entries, for changes() to stream back out. Likewise a documents table of per-document key counts, sizes and
+        timestamps (indexed by size), and a single row store_stats table of totals, are kept up to date so count(),
+        stat() and stats() are index lookups rather than scans.
+
+        Keys put with a ttl get an expires_at time, in an indexed column. Expired rows are filtered out of get(),
+        get_document() and count() straight away, and deleted (with their stats and change log entries) when get()
+        trips over one, by sweep(), or by a background Sweeper every "expiry_sweep_ms" (0 to disable), up to
+        "expiry_sweep_batch" rows at a time. stat() leaves expired rows out as count() does, stats() counts them
+        until they're deleted, so it stays a single row lookup. The sweeper starts with the first ttl put, or on
+        open() if expiring rows are already stored
         :param settings:
         """
         self.settings = settings
+        self.durability = settings.get("durability", self.DEFAULT_DURABILITY)
+        self.changes_retention = settings.get("changes_retention", self.CHANGES_RETENTION)
+        self._group_commit = None
+        self._sweeper = expiry.Sweeper(sweep_method=self.sweep,
+                                       interval_ms=settings.get("expiry_sweep_ms", expiry.SWEEP_INTERVAL_MS),
+                                       batch=settings.get("expiry_sweep_batch", expiry.SWEEP_BATCH))
+        self._local = threading.local()
+        self._connections = {}
+        self._connections_lock = threading.Lock()
 
     def open(self):
         """
-        Open function not used
+        Adds the changes and stats tables and the expires_at column to databases created before they existed, and
+        starts the group commit for batch durability. Connections are opened lazily per thread
         """
-        pass
+        expiring = None
+        with self._get_cursor() as cursor:
+            if self._create_tables(cursor):
+                expiring = cursor.execute("SELECT 1 FROM hiddil WHERE expires_at IS NOT NULL LIMIT 1;").fetchone()
 
-    def close(self, options: dict):
+        if self.durability == durability.BATCH:
+            self._group_commit = durability.GroupCommit(
+                commit_method=self._checkpoint,
+                interval_ms=self.settings.get("batch_interval_ms", durability.BATCH_INTERVAL_MS),
+                max_ops=self.settings.get("batch_ops", durability.BATCH_OPS))
+            self._group_commit.start()
+
+        if expiring:
+            self._sweeper.start_once()
+
+    def close(self, options: dict=None):
         """
-        Close function not used
+        Commits anything pending, then closes every per-thread connection opened by this instance
         """
-        pass
+        self._sweeper.stop()
+        if self._group_commit is not None:
+            self._group_commit.stop()
+            self._group_commit = None
+
+        # Finalizers take the lock themselves, so run them outside it
+        with self._connections_lock:
+            finalizers = list(self._connections.values())
+        for finalizer in finalizers:
+            finalizer()
+        self._local = threading.local()
 
     def create(self):
         """
         Creates a new database file at the path specified in settings dict.
         """
         with self._get_cursor() as cursor:
-            cursor.execute("""CREATE TABLE hiddil (uid VARCHAR(32), dkey VARCHAR(32), data BLOB, 
+            cursor.execute("""CREATE TABLE hiddil (uid VARCHAR(32), dkey VARCHAR(32), data BLOB, expires_at REAL,
                               PRIMARY KEY (uid, dkey));""")
+            self._create_tables(cursor)
 
     def get(self, uid: UID, key: str) -> bytes:
         """
         Fetches the bytes stored under the key for this UID.
         :param uid: UID instance to access
         :param key: Key string to lookup
-        :return: bytes stored or None if key doesn't exist or data is empty
+        :return: bytes stored or None if key doesn't exist, has expired or data is empty
         """
-        with self._get_cursor() as cursor:
-            result = cursor.execute("SELECT data FROM hiddil WHERE uid=? AND dkey=?;", (str(uid),key)).fetchone()
-            if result:
-                return result[0]
-            else:
-                return None
+        with self._get_cursor(exclusive=False) as cursor:
+            result = cursor.execute("SELECT data, expires_at FROM hiddil WHERE uid=? AND dkey=?;",
+                                    (str(uid), key)).fetchone()
+
+        # Reclaim an expired key on the way out, in its own write transaction
+        if result and result[1] is not None and result[1] <= time.time():
+            with self._get_cursor() as cursor:
+                reclaimed = self._delete(cursor, uid, key, expired_at=time.time())
+            if reclaimed:
+                self._written()
+            return None
+
+        if result:
+            return result[0]
+        else:
+            return None
 
     def get_document(self, uid) -> dict:
         """
@@ -71,24 +164,35 @@ class Sqlite3Backend:
         :param uid: ID instance to retrieve document for
         :return: Dict of key: value pairs
         """
-        with self._get_cursor() as cursor:
-            result = cursor.execute("SELECT dkey, data FROM hiddil WHERE uid=?;", (str(uid),)).fetchall()
+        with self._get_cursor(exclusive=False) as cursor:
+            result = cursor.execute("""SELECT dkey, data FROM hiddil WHERE uid=?
+                                       AND (expires_at IS NULL OR expires_at>?);""", (str(uid), time.time())).fetchall()
             if result:
                 return dict(result)
             else:
                 None
 
-    def put(self, uid: UID, key: str, data: bytes):
+    def put(self, uid: UID, key: str, data: bytes, ttl: float=None):
         """
         Stores data bytes against the key provided, for the document at the UID provided.
-        This operation replaces existing contents silently (upsert)
+        This operation replaces existing contents silently (upsert), including any expiry time
         :param uid: UID instance for the document to operate on
         :param key: Key string to store the data against
         :param data: Data bytes to store
+        :param ttl: Seconds until the key expires, or None to keep it indefinitely
         """
+        expires_at = time.time() + ttl if ttl is not None else None
 
         with self._get_cursor() as cursor:
-            cursor.execute("REPLACE INTO hiddil (uid, dkey, data) VALUES(?, ?, ?)", (str(uid), str(key), data,))
+            previous = cursor.execute("SELECT length(data) FROM hiddil WHERE uid=? AND dkey=?;",
+                                      (str(uid), str(key))).fetchone()
+            cursor.execute("REPLACE INTO hiddil (uid, dkey, data, expires_at) VALUES(?, ?, ?, ?)",
+                           (str(uid), str(key), data, expires_at))
+            self._update_stats(cursor, uid, 0 if previous else 1, len(data) - ((previous[0] or 0) if previous else 0))
+            self._log(cursor, "put", uid, key)
+        if ttl is not None:
+            self._sweeper.start_once()
+        self._written()
 
     def delete(self, uid, key):
         """
@@ -98,7 +202,8 @@ class Sqlite3Backend:
         :param key: Key string tfor the entry to remove
         """
         with self._get_cursor() as cursor:
-            cursor.execute("DELETE FROM hiddil WHERE uid=? AND dkey=?;", (str(uid), key))
+            self._delete(cursor, uid, key)
+        self._written()
 
     def delete_document(self, uid):
         """
@@ -108,6 +213,12 @@ class Sqlite3Backend:
         """
         with self._get_cursor() as cursor:
             cursor.execute("DELETE FROM hiddil WHERE uid=?;", (str(uid),))
+            if cursor.rowcount:
+                size = cursor.execute("SELECT bytes FROM documents WHERE uid=?;", (str(uid),)).fetchone()[0]
+                cursor.execute("DELETE FROM documents WHERE uid=?;", (str(uid),))
+                cursor.execute("UPDATE store_stats SET documents=documents-1, bytes=bytes-?;", (size,))
+                self._log(cursor, "delete_document", uid, None)
+        self._written()
 
     def sync(self, options: dict):
         """
@@ -120,13 +231,206 @@ class Sqlite3Backend:
         """
         Returns the number of keys associated to a UID
         :param uid: UID to count keys for
-        :return: number of keys (int)
+        :return: number of keys (int), not counting expired ones
         """
-        with self._get_cursor() as cursor:
-            return len(cursor.execute("SELECT uid FROM hiddil WHERE uid=?;", (str(uid),)).fetchall())
+        with self._get_cursor(exclusive=False) as cursor:
+            result = cursor.execute("SELECT keys FROM documents WHERE uid=?;", (str(uid),)).fetchone()
+            if not result:
+                return 0
+            expired = cursor.execute("SELECT COUNT(*) FROM hiddil WHERE uid=? AND expires_at<=?;",
+                                     (str(uid), time.time())).fetchone()[0]
+            return result[0] - expired
+
+    def stat(self, uid: UID) -> dict:
+        """
+        Returns the metadata kept for a UID, leaving out expired keys (as count() does) without deleting them.
+        The expired rows are found through the (uid, expires_at) index, so only those are read
+        :param uid: UID to describe
+        :return: Dict of keys (count), bytes (total data size), created and modified (timestamps)
+        """
+        with self._get_cursor(exclusive=False) as cursor:
+            result = cursor.execute("SELECT keys, bytes, created, modified FROM documents WHERE uid=?;",
+                                    (str(uid),)).fetchone()
+            expired = cursor.execute("""SELECT COUNT(*), COALESCE(SUM(length(data)), 0) FROM hiddil
+                                        WHERE uid=? AND expires_at<=?;""", (str(uid), time.time())).fetchone()
+
+        if not result or result[0] <= expired[0]:
+            raise DocumentNotFoundException
+        keys, size, created, modified = result
+        return {"keys": keys - expired[0], "bytes": size - expired[1], "created": created, "modified": modified}
+
+    def stats(self) -> dict:
+        """
+        Returns store-wide statistics from the store_stats and documents tables. Rows that have expired but haven't
+        been deleted yet (by the sweeper, sweep() or get()) are still counted
+        :return: Dict of documents (count), bytes (total data size) and largest (list of (uid, bytes), biggest first)
+        """
+        with self._get_cursor(exclusive=False) as cursor:
+            documents, size = cursor.execute("SELECT documents, bytes FROM store_stats;").fetchone()
+            largest = cursor.execute("SELECT uid, bytes FROM documents ORDER BY bytes DESC LIMIT ?;",
+                                     (self.LARGEST,)).fetchall()
+        return {"documents": documents, "bytes": size, "largest": largest}
 
-    def _get_cursor(self):
-        return self._Connection(self.settings["path"])
+    def changes(self, since: int=0, epoch: str=None):
+        """
+        Generator of changes made after the sequence number since, as (seq, op, uid, key) tuples, oldest first.
+        Changes are fetched a page at a time, so no transaction is held open between pages
+        :param since: Last sequence number already seen, 0 for everything
+        :param epoch: Epoch since was seen in, or None to trust since as is
+        :raises ChangesExpiredException: The changes table no longer goes back as far as since, or epoch belongs to
+                                         a different database
+        """
+        if epoch is not None and epoch != self.epoch():
+            raise ChangesExpiredException
+
+        while True:
+            with self._get_cursor(exclusive=False) as cursor:
+                page = cursor.execute("SELECT seq, op, uid, dkey FROM changes WHERE seq>? ORDER BY seq LIMIT ?;",
+                                      (since, self.CHANGES_PAGE_SIZE)).fetchall()
+
+            # Sequence numbers are contiguous, so a gap means entries we still needed were trimmed
+            if not page:
+                return
+            if page[0][0] != since + 1:
+                raise ChangesExpiredException
+
+            yield from page
+            since = page[-1][0]
+
+    def epoch(self) -> str:
+        """
+        Returns the change feed epoch. Sequence numbers are committed with the changes they describe, so they're
+        never reused and the epoch only identifies the database, it's fixed when the changes table is created
+        :return:
+        """
+        with self._get_cursor(exclusive=False) as cursor:
+            return cursor.execute("SELECT epoch FROM changes_epoch;").fetchone()[0]
+
+    def sweep(self, limit: int=expiry.SWEEP_BATCH) -> int:
+        """
+        Deletes up to limit expired keys, soonest expired first, in a single transaction
+        :param limit: Maximum number of keys to delete
+        :return: Number of keys deleted
+        """
+        now = time.time()
+        with self._get_cursor() as cursor:
+            due = cursor.execute("SELECT uid, dkey FROM hiddil WHERE expires_at<=? ORDER BY expires_at LIMIT ?;",
+                                 (now, limit)).fetchall()
+            for uid, key in due:
+                self._delete(cursor, uid, key)
+        if due:
+            self._written()
+        return len(due)
+
+    def _delete(self, cursor: sqlite3.Cursor, uid: UID, key: str, expired_at: float=None) -> bool:
+        # Delete a key in the caller's transaction, returning whether there was anything to delete. With expired_at
+        # set, only deletes the key if it's still expired at that time (it may have been put again since)
+        previous = cursor.execute("SELECT length(data), expires_at FROM hiddil WHERE uid=? AND dkey=?;",
+                                  (str(uid), key)).fetchone()
+        if not previous:
+            return False
+        if expired_at is not None and (previous[1] is None or previous[1] > expired_at):
+            return False
+
+        cursor.execute("DELETE FROM hiddil WHERE uid=? AND dkey=?;", (str(uid), key))
+        self._update_stats(cursor, uid, -1, -(previous[0] or 0))
+        self._log(cursor, "delete", uid, key)
+        return True
+
+    @staticmethod
+    def _create_tables(cursor: sqlite3.Cursor) -> bool:
+        # Returns whether the hiddil table exists yet
+        cursor.execute("""CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, op VARCHAR(16),
+                          uid VARCHAR(32), dkey VARCHAR(32));""")
+        cursor.execute("CREATE TABLE IF NOT EXISTS changes_epoch (epoch VARCHAR(32));")
+        if cursor.execute("SELECT COUNT(*) FROM changes_epoch;").fetchone()[0] == 0:
+            cursor.execute("INSERT INTO changes_epoch (epoch) VALUES(?);", (uuid.uuid4().hex,))
+        cursor.execute("""CREATE TABLE IF NOT EXISTS documents (uid VARCHAR(32) PRIMARY KEY, keys INTEGER,
+                          bytes INTEGER, created REAL, modified REAL);""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS documents_bytes ON documents (bytes);")
+        cursor.execute("CREATE TABLE IF NOT EXISTS store_stats (documents INTEGER, bytes INTEGER);")
+
+        # Skip the rest if we're opening a file create() hasn't been run on yet
+        if cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='hiddil';").fetchone() is None:
+            return False
+
+        # Files created before keys could expire need the column adding. The indexes only cover rows with a ttl, so
+        # stores that don't use them pay nothing for them. One orders expiry across the store for sweep(), the other
+        # finds a document's expired keys for count() without reading the rest of the document
+        if "expires_at" not in [column[1] for column in cursor.execute("PRAGMA table_info(hiddil);").fetchall()]:
+            cursor.execute("ALTER TABLE hiddil ADD COLUMN expires_at REAL;")
+        cursor.execute("CREATE INDEX IF NOT EXISTS hiddil_expires ON hiddil (expires_at) WHERE expires_at IS NOT NULL;")
+        cursor.execute("""CREATE INDEX IF NOT EXISTS hiddil_uid_expires ON hiddil (uid, expires_at)
+                          WHERE expires_at IS NOT NULL;""")
+
+        # First time round, fill the stats in from whatever is already stored (the one time this scans)
+        if cursor.execute("SELECT COUNT(*) FROM store_stats;").fetchone()[0] == 0:
+            now = time.time()
+            cursor.execute("""INSERT INTO documents (uid, keys, bytes, created, modified)
+                              SELECT uid, COUNT(*), COALESCE(SUM(length(data)), 0), ?, ? FROM hiddil
+                              GROUP BY uid;""", (now, now))
+            cursor.execute("""INSERT INTO store_stats (documents, bytes)
+                              SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM documents;""")
+        return True
+
+    @staticmethod
+    def _update_stats(cursor: sqlite3.Cursor, uid: UID, keys: int, size: int):
+        # Apply a change of keys and size bytes to a document's stats and the store totals, in the caller's transaction
+        now = time.time()
+        cursor.execute("UPDATE documents SET keys=keys+?, bytes=bytes+?, modified=? WHERE uid=?;",
+                       (keys, size, now, str(uid)))
+        if not cursor.rowcount:
+            cursor.execute("INSERT INTO documents (uid, keys, bytes, created, modified) VALUES(?, ?, ?, ?, ?);",
+                           (str(uid), keys, size, now, now))
+            cursor.execute("UPDATE store_stats SET documents=documents+1;")
+
+        # Drop the stats row with the document's last key
+        elif cursor.execute("SELECT keys FROM documents WHERE uid=?;", (str(uid),)).fetchone()[0] <= 0:
+            cursor.execute("DELETE FROM documents WHERE uid=?;", (str(uid),))
+            cursor.execute("UPDATE store_stats SET documents=documents-1;")
+
+        cursor.execute("UPDATE store_stats SET bytes=bytes+?;", (size,))
+
+    def _log(self, cursor: sqlite3.Cursor, op: str, uid: UID, key: str):
+        # Log the change in the caller's transaction, and trim the oldest entries beyond the retention limit
+        cursor.execute("INSERT INTO changes (op, uid, dkey) VALUES(?, ?, ?);", (op, str(uid), key))
+        cursor.execute("DELETE FROM changes WHERE seq<=?;", (cursor.lastrowid - self.changes_retention,))
+
+    def _written(self):
+        if self._group_commit is not None:
+            self._group_commit.record()
+
+    def _checkpoint(self):
+        # Checkpointing syncs the WAL, then copies it back into the database file and syncs that
+        self._get_connection().execute("PRAGMA wal_checkpoint(PASSIVE);")
+
+    def _get_cursor(self, exclusive: bool=True) -> _Connection:
+        return self._Connection(self._get_connection(), exclusive)
+
+    def _get_connection(self) -> sqlite3.Connection:
+        # Fetch this thread's connection, opening it on first use. check_same_thread is off so close() can tidy up
+        # connections from any thread, but each connection is only ever used by the thread that opened it
+        holder = getattr(self._local, "holder", None)
+        if holder is None:
+            conn = sqlite3.connect(self.settings["path"], timeout=self.BUSY_TIMEOUT, isolation_level=None,
+                                   check_same_thread=False)
+            for pragma in self.PRAGMAS[self.durability]:
+                conn.execute(pragma)
+            holder = self._local.holder = self._ThreadConnection(conn)
+
+            # Close the connection once the thread exits and its locals (so the holder) are dropped, otherwise a
+            # thread per request server leaks a file descriptor per request
+            with self._connections_lock:
+                self._connections[id(conn)] = weakref.finalize(holder, self._close_connection, self._connections,
+                                                               self._connections_lock, conn)
+        return holder.conn
+
+    @staticmethod
+    def _close_connection(connections: dict, lock: threading.Lock, conn: sqlite3.Connection):
+        # Runs once per connection, from weakref.finalize, so mustn't reference the backend itself
+        with lock:
+            connections.pop(id(conn), None)
+        conn.close()
 
 
 def test_sqlite3_backend():
@@ -145,8 +449,10 @@ def test_sqlite3_backend():
     backend.put(u1, "second", "second_entry".encode("utf-8"))
     assert backend.get(u1, "second") == b'second_entry'
 
-    # Test count()
+    # Test count(), stat() and stats()
     assert backend.count(u1) == 2
+    assert backend.stat(u1)["bytes"] == len(b'first_entry') + len(b'second_entry')
+    assert backend.stats()["documents"] == 1 and backend.stats()["largest"] == [(str(u1), 23)]
 
     # Test delete()
     backend.delete(u1, "first")
@@ -158,12 +464,196 @@ def test_sqlite3_backend():
     # Test delete_document()
     backend.delete_document(u1)
     assert backend.get_document(u1) is None
+    assert backend.stats() == {"documents": 0, "bytes": 0, "largest": []}
+
+    # Test changes()
+    assert [change[1:] for change in backend.changes()] == [("put", str(u1), "first"), ("put", str(u1), "second"),
+                                                            ("delete", str(u1), "first"),
+                                                            ("delete_document", str(u1), None)]
+    assert [change[0] for change in backend.changes(since=2)] == [3, 4]
+    assert [change[0] for change in backend.changes(since=2, epoch=backend.epoch())] == [3, 4]
+    try:
+        list(backend.changes(since=2, epoch="another database"))
+    except ChangesExpiredException:
+        pass
+    else:
+        raise AssertionError("Epoch from another database was accepted")
+
+    # Once the log is trimmed, since=0 no longer reaches back to the start of the store
+    backend.changes_retention = 2
+    backend.put(u1, "third", b'third_entry')
+    try:
+        list(backend.changes())
+    except ChangesExpiredException:
+        pass
+    else:
+        raise AssertionError("Trimmed changes were not reported")
+    assert [change[0] for change in backend.changes(since=3)] == [4, 5]
+
+    # Deleting a document's last key deletes the document, as far as stats are concerned too
+    backend.delete(u1, "third")
+    assert backend.get_document(u1) is None and backend.stats()["documents"] == 0
 
     # Clean up test file afterwards
+    backend.close()
     os.remove("test.db")
 
 
+def test_sqlite3_expiry():
+    import os
+
+    def rows(backend: Sqlite3Backend) -> int:
+        # Rows actually stored, expired or not
+        with backend._get_cursor(exclusive=False) as cursor:
+            return cursor.execute("SELECT COUNT(*) FROM hiddil;").fetchone()[0]
+
+    # No background sweeper, so expired rows stay put until something reclaims them
+    backend = Sqlite3Backend({"path": "test_expiry.db", "expiry_sweep_ms": 0})
+    backend.create()
+    u1 = UID("01aaaaaaaaaaaaaaaaaaaaaaaaaaaaaa")
+    u2 = UID("02aaaaaaaaaaaaaaaaaaaaaaaaaaaaaa")
+    backend.put(u1, "live", b'x')
+    backend.put(u1, "expired", b'xx', ttl=0.05)
+    backend.put(u1, "later", b'xxx', ttl=1000)
+    time.sleep(0.1)
+
+    # Expired rows are hidden from every read before they're deleted
+    assert backend.get_document(u1) == {"live": b'x', "later": b'xxx'} and backend.count(u1) == 2 and rows(backend) == 3
+
+    # get() deletes the expired row it finds, logging it like any other delete
+    assert backend.get(u1, "expired") is None and rows(backend) == 2
+    assert [change[1:] for change in backend.changes()][-1] == ("delete", str(u1), "expired")
+
+    # Putting a key again without a ttl clears its expiry
+    backend.put(u1, "live", b'y', ttl=0.05)
+    backend.put(u1, "live", b'x')
+    time.sleep(0.1)
+    assert backend.get(u1, "live") == b'x'
+
+    # sweep() deletes at most limit rows per call, and documents go with their last key
+    for index in range(5):
+        backend.put(UID("1{}aaaaaaaaaaaaaaaaaaaaaaaaaaaaaa".format(index)), "a", b'x', ttl=0.05)
+    time.sleep(0.1)
+    assert backend.sweep(2) == 2 and backend.sweep(10) == 3 and backend.sweep(10) == 0
+    assert rows(backend) == 2 and backend.stats()["documents"] == 1
+
+    # stat() leaves expired rows out like count(), without deleting them. stats() counts them until they're
+    # deleted, so it stays a single row lookup
+    backend.put(u1, "stale", b'xxxxx', ttl=0.05)
+    backend.put(u2, "a", b'x', ttl=0.05)
+    time.sleep(0.1)
+    assert backend.stat(u1)["keys"] == backend.count(u1) == 2 and backend.stat(u1)["bytes"] == 4
+    try:
+        backend.stat(u2)
+    except DocumentNotFoundException:
+        pass
+    else:
+        raise AssertionError("Document with only expired keys has stats")
+    assert backend.stats()["documents"] == 2 and backend.stats()["bytes"] == 10 and rows(backend) == 4
+    assert backend.sweep(10) == 2
+    assert backend.stats() == {"documents": 1, "bytes": 4, "largest": [(str(u1), 4)]} and rows(backend) == 2
+    backend.close()
+
+    # Expiry times are stored, and reopening a store with expiring rows starts the sweeper
+    backend = Sqlite3Backend({"path": "test_expiry.db", "expiry_sweep_ms": 10})
+    backend.open()
+    assert backend._sweeper._thread is not None and backend.count(u1) == 2
+    backend.put(u1, "expired", b'xx', ttl=0.05)
+    deadline = time.time() + 5
+    while rows(backend) > 2 and time.time() < deadline:
+        time.sleep(0.01)
+    assert rows(backend) == 2 and backend.stat(u1)["keys"] == 2
+    backend.close()
+    os.remove("test_expiry.db")
+
+    # Files created before keys could expire have the column added by open(), and keep their rows
+    conn = sqlite3.connect("test_expiry.db")
+    conn.execute("CREATE TABLE hiddil (uid VARCHAR(32), dkey VARCHAR(32), data BLOB, PRIMARY KEY (uid, dkey));")
+    conn.execute("INSERT INTO hiddil (uid, dkey, data) VALUES(?, ?, ?);", (str(u1), "old", b'xx'))
+    conn.commit()
+    conn.close()
+    backend = Sqlite3Backend({"path": "test_expiry.db", "expiry_sweep_ms": 0})
+    backend.open()
+    assert backend._sweeper._thread is None and backend.get_document(u1) == {"old": b'xx'}
+    backend.put(u1, "new", b'x', ttl=0.05)
+    time.sleep(0.1)
+    assert backend.count(u1) == 1 and backend.stat(u1)["keys"] == 1 and backend.stat(u1)["bytes"] == 2
+    backend.close()
+    os.remove("test_expiry.db")
+
+
+def _run_threads(count: int, target) -> float:
+    # Runs target(index) on count threads, returning the elapsed time. Exceptions on the workers are collected and
+    # re-raised here, otherwise a failed assert would only be printed and the test would still pass
+    import time
+
+    errors = []
+
+    def run(index: int):
+        try:
+            target(index)
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    if errors:
+        raise errors[0]
+    return elapsed
+
+
+def test_sqlite3_threads(thread_counts=(1, 2, 4, 8), ops_per_thread: int=200):
+    import os
+
+    backend = Sqlite3Backend({"path": "test_threads.db"})
+    backend.create()
+
+    def writer(index: int):
+        uid = UID("{:02d}".format(index) + "a" * 30)
+        for op in range(ops_per_thread):
+            key = "key{}".format(op % 16)
+            backend.put(uid, key, str(op).encode("utf-8"))
+            assert backend.get(uid, key) == str(op).encode("utf-8")
+
+    def reader(index: int):
+        uid = UID("{:02d}".format(index) + "a" * 30)
+        for op in range(2 * ops_per_thread):
+            assert backend.get(uid, "key{}".format(op % 16)) is not None
+
+    # Hammer one shared instance with increasing thread counts, and report throughput for each. This checks
+    # correctness under contention rather than scaling: sqlite serialises writers, so write throughput doesn't grow
+    # with threads, and while readers don't block each other, short reads spend most of their time holding the GIL
+    for count in thread_counts:
+        write_time = _run_threads(count, writer)
+        read_time = _run_threads(count, reader)
+        print("{} threads: {:.0f} write ops/s, {:.0f} read ops/s".format(
+            count, 2 * count * ops_per_thread / write_time, 2 * count * ops_per_thread / read_time))
+
+        # Every thread's document should be complete and untouched by the others
+        for index in range(count):
+            assert backend.count(UID("{:02d}".format(index) + "a" * 30)) == min(16, ops_per_thread)
+
+    # Connections are closed as their threads exit, so only this thread's is still open
+    assert len(backend._connections) == 1
+    for _ in range(50):
+        _run_threads(1, reader)
+    assert len(backend._connections) == 1
+
+    # Clean up test file afterwards
+    backend.close()
+    assert len(backend._connections) == 0
+    os.remove("test_threads.db")
+
+
 if __name__ == "__main__":
 
     test_sqlite3_backend()
+    test_sqlite3_expiry()
+    test_sqlite3_threads()
     print("done")